@@ -0,0 +1,153 @@
+import glob
+import os
+import struct
+import time
+import numpy as np
+
+backends = ['picamera', 'synthetic', 'replay']
+
+def pack10(bayer):
+	# Inverse of mybayer.unpack10, laid out like the OV5647 raw block
+	height, width = bayer.shape
+	stride = (width * 5 // 4 + 31) // 32 * 32
+	packed = np.zeros(((height + 15) // 16 * 16, stride), dtype=np.uint8)
+	groups = bayer.reshape(height, width // 4, 4)
+	body = packed[:height, :width * 5 // 4].reshape(height, width // 4, 5)
+	body[:, :, :4] = groups >> 2
+	body[:, :, 4] = np.bitwise_or.reduce(((groups & 3) << np.array([0, 2, 4, 6])).astype(np.uint8), axis=2)
+	header = bytearray(32768)
+	header[0:4] = b'BRCM'
+	struct.pack_into('<HH', header, 176 + 32, width, height)
+	header[176 + 68] = 1
+	return bytes(header) + packed.tobytes()
+
+class SyntheticCamera:
+	# Stands in for PiCamera, rendering a test pattern with a moving bar.
+	# Seconds lost to the mode switch of every still port capture
+	still_delay = 0
+
+	def __init__(self, resolution = (1920, 1080)):
+		self.resolution = resolution
+		self.sensor_mode = 0
+		self.framerate = 30
+		self.shutter_speed = 0
+		self.iso = 0
+		self.exposure_mode = 'auto'
+		self.awb_mode = 'auto'
+		self.awb_gains = (1.5, 1.2)
+		self.rotation = 0
+		self.annotate_text = ''
+		self.analog_gain = 1
+		self.digital_gain = 1
+		self.exposure_speed = 33333
+		# Scene brightness, 1 is well exposed at 1/30s and ISO 100
+		self.light = 1.0
+		self.num = 0
+		self.base = None
+		self.bayer = None
+
+	def render(self, resize = None):
+		width, height = self.resolution
+		if (self.base is None or self.base.shape[:2] != (height, width)):
+			x = np.linspace(0, 255, width, dtype=np.float32)
+			y = np.linspace(0, 255, height, dtype=np.float32)
+			self.base = np.empty((height, width, 3), dtype=np.uint8)
+			self.base[:, :, 0] = x[np.newaxis, :]
+			self.base[:, :, 1] = y[:, np.newaxis]
+			self.base[:, :, 2] = 127
+		# A moving bar, so consecutive frames differ
+		frame = self.base.copy()
+		pos = (self.num * 16) % width
+		frame[:, pos:pos + 16] = 255
+		self.num += 1
+		if (self.shutter_speed > 0):
+			# A fixed exposure scales the light, seen through the gamma of the JPEG encoder
+			scale = (self.shutter_speed / 33333 * max(self.iso, 100) / 100 * self.light) ** (1 / 2.2)
+			lut = np.clip(np.arange(256) * scale, 0, 255).astype(np.uint8)
+			frame = lut[frame]
+		if (resize is not None):
+			from PIL import Image
+			frame = np.asarray(Image.fromarray(frame).resize(resize))
+		return frame
+
+	def render_bayer(self):
+		if (self.bayer is None):
+			# Sensor resolution of the OV5647, whatever the output resolution
+			# A ramp over the full 10 bit range, worked out in 32 bits where x * 1023 fits
+			x = np.arange(2592, dtype=np.int32) * 1023 // 2592
+			y = np.arange(1944, dtype=np.int32)[:, np.newaxis] & 0xff
+			self.bayer = pack10(((x + y) & 1023).astype(np.uint16))
+		return self.bayer
+
+	def write(self, output, format, frame):
+		if (isinstance(output, str) or format in ('png', 'jpeg', 'bmp')):
+			from PIL import Image
+			if (format is None):
+				format = output.rsplit('.', 1)[-1]
+			Image.fromarray(frame).save(output, format=format)
+			return
+		height, width = frame.shape[:2]
+		pad_width = (width + 31) // 32 * 32
+		pad_height = (height + 15) // 16 * 16
+		if (format == 'yuv'):
+			padded = np.zeros((pad_height * 3 // 2, pad_width), dtype=np.uint8)
+			padded[:height, :width] = frame[:, :, 1]
+		else:
+			padded = np.zeros((pad_height, pad_width, 3), dtype=np.uint8)
+			padded[:height, :width] = frame
+		if (hasattr(output, 'write')):
+			output.write(memoryview(padded.reshape(-1)))
+		else:
+			output.reshape(-1)[:padded.size] = padded.reshape(-1)
+
+	def capture(self, output, format = None, use_video_port = False, resize = None, splitter_port = 0, bayer = False):
+		if (not use_video_port):
+			time.sleep(self.still_delay)
+		self.write(output, format, self.render(resize))
+		if (bayer):
+			output.write(self.render_bayer())
+
+	def capture_continuous(self, output, format = None, use_video_port = False, resize = None, splitter_port = 0, burst = False, bayer = False):
+		while True:
+			self.write(output, format, self.render(resize))
+			yield output
+
+	def close(self):
+		pass
+
+class ReplayCamera(SyntheticCamera):
+	# Plays back the images in a folder, in name order and over and over
+	extensions = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.ppm', '.bmp')
+
+	def __init__(self, path):
+		from PIL import Image
+		files = sorted(glob.glob(os.path.join(path, '*')))
+		self.files = [f for f in files if f.lower().endswith(self.extensions)]
+		if (len(self.files) == 0):
+			raise ValueError("No images to replay in '{}'".format(path))
+		with Image.open(self.files[0]) as image:
+			resolution = image.size
+		SyntheticCamera.__init__(self, resolution)
+
+	def render(self, resize = None):
+		from PIL import Image
+		filename = self.files[self.num % len(self.files)]
+		self.num += 1
+		size = resize if resize is not None else tuple(self.resolution)
+		with Image.open(filename) as image:
+			image = image.convert('RGB')
+			if (image.size != size):
+				image = image.resize(size)
+			return np.asarray(image)
+
+def open_camera(backend = 'picamera', path = None):
+	print("Open camera: {}".format(backend))
+	if (backend == 'picamera'):
+		# Only imported here, everything else runs on machines without the camera module
+		from picamera import PiCamera
+		return PiCamera()
+	if (backend == 'synthetic'):
+		return SyntheticCamera()
+	if (backend == 'replay'):
+		return ReplayCamera(path)
+	raise ValueError("Unknown camera backend '{}'".format(backend))
@@ -0,0 +1,112 @@
+import struct
+import numpy as np
+
+header_size = 32768
+
+# Size of the raw block appended to the JPEG, by sensor
+raw_sizes = {
+	'ov5647': 6404096,
+	'imx219': 10270208,
+}
+
+# Row and column of the red, green, green and blue sites, by the header's bayer order
+bayer_offsets = {
+	0: ((0, 0), (1, 0), (0, 1), (1, 1)),
+	1: ((1, 0), (0, 0), (1, 1), (0, 1)),
+	2: ((1, 1), (0, 1), (1, 0), (0, 0)),
+	3: ((0, 1), (1, 1), (0, 0), (1, 0)),
+}
+
+# ITU-R 601 luma weights, the ones PIL uses for convert('L')
+luma = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+# Bit position of each pixel's two low bits in the fifth byte
+low_shifts = np.array([0, 2, 4, 6], dtype=np.uint8)
+
+def find_raw(data):
+	for size in raw_sizes.values():
+		if (len(data) >= size and data[-size:-size + 4] == b'BRCM'):
+			return data[-size:]
+	offset = data.rfind(b'BRCM')
+	if (offset < 0):
+		raise ValueError("No raw bayer data found")
+	return data[offset:]
+
+def parse_header(raw):
+	width, height = struct.unpack_from('<HH', raw, 176 + 32)
+	order = raw[176 + 68]
+	return width, height, order
+
+def unpack10(data, width, height):
+	# Every 5 bytes hold the high 8 bits of 4 pixels followed by their low 2 bits
+	packed = np.frombuffer(data, dtype=np.uint8)
+	stride = (width * 5 // 4 + 31) // 32 * 32
+	packed = packed[:packed.size // stride * stride].reshape(-1, stride)
+	packed = packed[:height, :width * 5 // 4].reshape(height, width // 4, 5)
+	pixels = np.empty((height, width // 4, 4), dtype=np.uint16)
+	np.left_shift(packed[:, :, :4], 2, out=pixels, dtype=np.uint16)
+	pixels |= (packed[:, :, 4:] >> low_shifts) & 3
+	return pixels.reshape(height, width)
+
+def extract(data):
+	raw = find_raw(data)
+	width, height, order = parse_header(raw)
+	bayer = unpack10(raw[header_size:], width, height)
+	return bayer, order
+
+def demosaic_superpixel(bayer, order):
+	# Every 2x2 block becomes one pixel, half the resolution but no interpolation
+	(ry, rx), (gy, gx), (Gy, Gx), (by, bx) = bayer_offsets[order]
+	height, width = bayer.shape
+	rgb = np.empty((height // 2, width // 2, 3), dtype=np.uint16)
+	rgb[:, :, 0] = bayer[ry::2, rx::2]
+	rgb[:, :, 1] = (bayer[gy::2, gx::2].astype(np.uint32) + bayer[Gy::2, Gx::2]) >> 1
+	rgb[:, :, 2] = bayer[by::2, bx::2]
+	return rgb
+
+def demosaic_bilinear(bayer, order):
+	(ry, rx), (gy, gx), (Gy, Gx), (by, bx) = bayer_offsets[order]
+	height, width = bayer.shape
+	# Reflecting keeps the colour of the pixels just outside the border
+	padded = np.pad(bayer, 1, mode='reflect').astype(np.uint32)
+
+	def at(y, x, dy, dx):
+		# The neighbour at (dy, dx) of every site (y, x) of the 2x2 pattern
+		return padded[1 + y + dy:1 + y + dy + height:2, 1 + x + dx:1 + x + dx + width:2]
+
+	def cross(y, x):
+		return (at(y, x, -1, 0) + at(y, x, 1, 0) + at(y, x, 0, -1) + at(y, x, 0, 1)) >> 2
+
+	def diagonal(y, x):
+		return (at(y, x, -1, -1) + at(y, x, -1, 1) + at(y, x, 1, -1) + at(y, x, 1, 1)) >> 2
+
+	def horizontal(y, x):
+		return (at(y, x, 0, -1) + at(y, x, 0, 1)) >> 1
+
+	def vertical(y, x):
+		return (at(y, x, -1, 0) + at(y, x, 1, 0)) >> 1
+
+	rgb = np.empty((height, width, 3), dtype=np.uint16)
+	rgb[ry::2, rx::2, 0] = bayer[ry::2, rx::2]
+	rgb[ry::2, rx::2, 1] = cross(ry, rx)
+	rgb[ry::2, rx::2, 2] = diagonal(ry, rx)
+	rgb[by::2, bx::2, 0] = diagonal(by, bx)
+	rgb[by::2, bx::2, 1] = cross(by, bx)
+	rgb[by::2, bx::2, 2] = bayer[by::2, bx::2]
+	for y, x in ((gy, gx), (Gy, Gx)):
+		rgb[y::2, x::2, 1] = bayer[y::2, x::2]
+		if (y == ry):
+			rgb[y::2, x::2, 0] = horizontal(y, x)
+			rgb[y::2, x::2, 2] = vertical(y, x)
+		else:
+			rgb[y::2, x::2, 0] = vertical(y, x)
+			rgb[y::2, x::2, 2] = horizontal(y, x)
+	return rgb
+
+demosaics = {
+	'bilinear': demosaic_bilinear,
+	'superpixel': demosaic_superpixel,
+}
+
+def demosaic(bayer, order, method = 'bilinear'):
+	return demosaics[method](bayer, order)
@@ -0,0 +1,177 @@
+import argparse
+import math
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+from PIL import Image
+from mybackend import SyntheticCamera
+
+def measure(name, func, number):
+	func()
+	t1 = time.time()
+	for i in range(number):
+		func()
+	t2 = time.time()
+	print("{:<32} {:>8.1f} ms {:>8.2f} fps".format(name, (t2 - t1)*1000/number, number/(t2 - t1)))
+
+def bench_capture(args):
+	from mycamera import MyCamera
+
+	mycam = MyCamera(backend='synthetic')
+	mycam.camera.resolution = tuple(args.resolution)
+	measure("capture_image (png)", lambda: mycam.capture_image().load(), args.number)
+	measure("capture_array (rgb)", lambda: mycam.capture_array(), args.number)
+	measure("capture_array (yuv)", lambda: mycam.capture_array('yuv'), args.number)
+
+def bench_stream(args):
+	from mycamera import MyCamera
+
+	mycam = MyCamera(backend='synthetic')
+	mycam.camera.resolution = tuple(args.resolution)
+	mycam.camera.still_delay = args.still_delay
+	measure("capture_array (still port)", lambda: mycam.capture_array(), args.number)
+	measure("capture_stream (video port)", lambda: mycam.capture_stream(), args.number)
+	measure("capture_stream (resized)", lambda: mycam.capture_stream(resize=True), args.number)
+	mycam.stop_stream()
+
+def bench_bayer(args):
+	import mybayer
+
+	data = SyntheticCamera().render_bayer()
+	bayer, order = mybayer.extract(data)
+	measure("unpack10", lambda: mybayer.extract(data), args.number)
+	measure("demosaic (superpixel)", lambda: mybayer.demosaic(bayer, order, 'superpixel'), args.number)
+	measure("demosaic (bilinear)", lambda: mybayer.demosaic(bayer, order, 'bilinear'), args.number)
+
+def bench_stages(args):
+	import mypipeline
+
+	frame = SyntheticCamera(tuple(args.resolution)).render()
+	image = Image.fromarray(frame)
+	avg_image = image.copy()
+	measure("average (Image.blend)", lambda: Image.blend(avg_image, image, 0.3), args.number)
+
+	def old_diff():
+		now = np.array(image.convert('L')).astype(np.int64)
+		avg = np.array(avg_image.convert('L')).astype(np.int64)
+		diff = (now - avg)*10
+		return Image.fromarray((np.absolute(diff - diff.mean()) + 127).astype(np.uint8))
+	measure("diff (int64 arrays)", old_diff, args.number)
+
+	avg = frame.astype(np.uint16) << 8
+	out = np.empty(frame.shape, dtype=np.uint16)
+	tmp = np.empty((mypipeline.strip_rows(frame.shape),) + frame.shape[1:], dtype=np.uint16)
+	image = np.empty(frame.shape, dtype=np.uint8)
+	gray = np.empty(frame.shape[:2], dtype=np.float32)
+	scratch = np.empty(tmp.shape[:2], dtype=np.float32)
+	diff = np.empty(frame.shape[:2], dtype=np.uint8)
+	measure("average_frame (fixed point)", lambda: mypipeline.average_frame(frame, avg, out, tmp, 0.3), args.number)
+	measure("average_image (when shown)", lambda: mypipeline.average_image(out, image), args.number)
+	measure("diff_frame (in place)", lambda: mypipeline.diff_frame(frame, out, gray, scratch, diff, 10), args.number)
+
+def fourier_shift(frame, dy, dx):
+	# frame(p - s), exact for any fraction of a pixel
+	ky = np.fft.fftfreq(frame.shape[0])[:, np.newaxis]
+	kx = np.fft.fftfreq(frame.shape[1])[np.newaxis, :]
+	return np.real(np.fft.ifft2(np.fft.fft2(frame) * np.exp(-2j * np.pi * (ky * dy + kx * dx))))
+
+def bench_register(args):
+	import myregister
+
+	# A smooth random texture, the synthetic scene has too little detail to lock on
+	width, height = args.resolution
+	rng = np.random.default_rng(1)
+	ky = np.fft.fftfreq(height)[:, np.newaxis]
+	kx = np.fft.fftfreq(width)[np.newaxis, :]
+	texture = np.real(np.fft.ifft2(np.fft.fft2(rng.random((height, width))) * np.exp(-(ky**2 + kx**2) / 0.0128)))
+	texture = (texture - texture.min()) / (texture.max() - texture.min()) * 200 + 20
+	# Float frames at full size, so only the estimate itself can be off
+	for dy, dx in [(-0.25, 0.75), (0.5, 0.5), (3.4, -5.7)]:
+		frame = fourier_shift(texture, dy, dx)
+		registration = myregister.Registration(factor=1)
+		registration.set_reference(texture)
+		transform = registration.estimate(frame)
+		error = math.hypot(transform.dy - dy, transform.dx - dx)
+		print("shift {:+.2f} {:+.2f}: {} error {:.2f} {}".format(dy, dx, transform, error, "ok" if error < 1 / registration.upsample else "WRONG"))
+	measure("estimate (shift)", lambda: registration.estimate(frame), args.number)
+
+class NullCanvas:
+	def __init__(self):
+		self.frames = 0
+
+	def post_frame(self, array, timestamp, full = None):
+		self.frames += 1
+
+def bench_startup(args):
+	# Every import in a fresh interpreter, as on a cold start
+	for module in ['mycamera', 'mypipeline', 'mycamgui']:
+		code = "import time; t = time.monotonic(); import {}; print(time.monotonic() - t)".format(module)
+		# From the folder of this script, where the modules are whatever the working folder
+		elapsed = float(subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__))))
+		print("{:<32} {:>8.1f} ms".format("import " + module, elapsed * 1000))
+
+	import mymetrics
+	from mycamera import MyCamera
+	from mypipeline import LiveUpdater
+	mycam = MyCamera(backend='synthetic')
+	mycam.open()
+	canvas = NullCanvas()
+	updater = LiveUpdater(mycam, canvas)
+	updater.start()
+	updater.live(True)
+	while canvas.frames == 0:
+		time.sleep(0.001)
+	print("{:<32} {:>8.1f} ms".format("process start to first frame", mymetrics.uptime() * 1000))
+	updater.live(False)
+	updater.join()
+
+def bench_pipeline(args):
+	# The whole live pipeline, headless
+	from mycamera import MyCamera
+	from mypipeline import LiveUpdater
+	mycam = MyCamera(backend=args.backend, path=args.replay)
+	mycam.camera.resolution = tuple(args.resolution)
+	canvas = NullCanvas()
+	updater = LiveUpdater(mycam, canvas, processes=args.processes)
+	updater.start()
+	updater.live(True)
+	t1 = time.time()
+	while canvas.frames < args.number:
+		time.sleep(0.01)
+	t2 = time.time()
+	updater.live(False)
+	updater.join()
+	print("{:<32} {:>8.1f} ms {:>8.2f} fps".format("live pipeline", (t2 - t1)*1000/args.number, args.number/(t2 - t1)))
+
+def parse_args():
+	parser = argparse.ArgumentParser(description="MyCamera benchmarks")
+	parser.add_argument('bench', help='Benchmark', choices=['capture', 'stream', 'stages', 'bayer', 'register', 'startup', 'pipeline'])
+	parser.add_argument('--number', '-n', help='Number of frames', type=int, default=20)
+	parser.add_argument('--resolution', '-r', help='Resolution', type=int, nargs=2, default=[1920, 1080])
+	parser.add_argument('--still-delay', help='Simulated still port mode switch in seconds', type=float, default=0.5)
+	parser.add_argument('--backend', help='Camera backend of the pipeline benchmark', default='synthetic')
+	parser.add_argument('--replay', help='Folder of images for the replay backend')
+	parser.add_argument('--processes', '-p', help='Run the heavy stages in a pool of processes', type=int, default=0)
+	return parser.parse_args()
+
+def main():
+	args = parse_args()
+	if (args.bench == 'capture'):
+		bench_capture(args)
+	if (args.bench == 'stream'):
+		bench_stream(args)
+	if (args.bench == 'stages'):
+		bench_stages(args)
+	if (args.bench == 'bayer'):
+		bench_bayer(args)
+	if (args.bench == 'register'):
+		bench_register(args)
+	if (args.bench == 'startup'):
+		bench_startup(args)
+	if (args.bench == 'pipeline'):
+		bench_pipeline(args)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,152 @@
+import collections
+import os
+import threading
+import numpy as np
+import mystack
+import mywriter
+import myhotpixel
+
+kinds = ['dark', 'bias', 'flat', 'hot']
+
+def master_key(kind, key):
+	resolution, sensor_mode, exposure, iso = key
+	if (kind == 'bias'):
+		return (resolution, sensor_mode, 0, iso)
+	if (kind == 'flat'):
+		# Flats depend on the optics, not on exposure or gain
+		return (resolution, sensor_mode, 0, 0)
+	return (resolution, sensor_mode, exposure, iso)
+
+def area_mean(data, size, axis):
+	# Mean over each of size equal spans along the axis, the spans need not end on pixel
+	# edges. Running sums are exact integrals of the pixels, linear in between
+	data = np.moveaxis(data, axis, 0)
+	count = data.shape[0]
+	sums = np.zeros((count + 1,) + data.shape[1:])
+	np.cumsum(data, axis=0, out=sums[1:])
+	edges = np.arange(size + 1) * count / size
+	index = np.minimum(edges.astype(np.intp), count - 1)
+	fraction = (edges - index).reshape((size + 1,) + (1,) * (data.ndim - 1))
+	integral = sums[index] + (sums[index + 1] - sums[index]) * fraction
+	return np.moveaxis(np.diff(integral, axis=0) * (size / count), 0, axis)
+
+def fit(master, shape):
+	if (master is None or master.shape == shape):
+		return master
+	if (master.ndim != len(shape)):
+		return None
+	# Averaged over the area each preview pixel covers, as the camera's resizer does.
+	# Sampled instead, single hot pixels would land on arbitrary preview pixels
+	for axis in range(2):
+		master = area_mean(master, shape[axis], axis)
+	return master.astype(np.float32)
+
+class CalibrationLibrary:
+	def __init__(self, path = '/share/pics/calib', size = 8):
+		self.path = path
+		self.size = size
+		self.cache = collections.OrderedDict()
+		self.lock = threading.Lock()
+
+	def filename(self, kind, key):
+		(width, height), sensor_mode, exposure, iso = master_key(kind, key)
+		name = "{}_{}x{}_m{}_e{}_i{}.npy".format(kind, width, height, sensor_mode, exposure, iso)
+		return os.path.join(self.path, name)
+
+	def cached(self, name, load):
+		with self.lock:
+			if (name in self.cache):
+				self.cache.move_to_end(name)
+				return self.cache[name]
+		value = load()
+		self.store(name, value)
+		return value
+
+	def store(self, name, value):
+		with self.lock:
+			self.cache[name] = value
+			self.cache.move_to_end(name)
+			while len(self.cache) > self.size:
+				self.cache.popitem(last=False)
+
+	def get(self, kind, key):
+		filename = self.filename(kind, key)
+		def load():
+			if (not os.path.exists(filename)):
+				return None
+			print("Load '{}'".format(filename))
+			return np.load(filename)
+		return self.cached(filename, load)
+
+	def build(self, kind, key, frames):
+		if (kind == 'hot'):
+			# Not a frame but the position of every hot pixel
+			builder = myhotpixel.HotPixelBuilder()
+			for frame in frames:
+				builder.add(frame)
+			return self.save(kind, key, builder.result(key[0]), builder.count)
+
+		# Streaming mean, whatever the number of frames only one master is in memory
+		stacker = mystack.MeanStacker()
+		for frame in frames:
+			stacker.add(frame)
+		master = stacker.result()
+		if (kind == 'flat'):
+			bias = self.get('bias', key)
+			if (bias is not None and bias.shape == master.shape):
+				master -= bias
+		return self.save(kind, key, master, stacker.count)
+
+	def save(self, kind, key, master, count):
+		filename = self.filename(kind, key)
+		os.makedirs(self.path, exist_ok=True)
+		mywriter.write_atomic(filename, mywriter.encode(master, 'npy'))
+		print("Built '{}' from {} frames".format(filename, count))
+		with self.lock:
+			# Anything derived from the old master is stale
+			self.cache.clear()
+		self.store(filename, master)
+		return master
+
+class Calibrator:
+	def __init__(self, library):
+		self.library = library
+		self.temp = {}
+
+	def masters(self, key, shape):
+		def load():
+			dark = self.library.get('dark', key)
+			if (dark is None):
+				dark = self.library.get('bias', key)
+			flat = self.library.get('flat', key)
+			offset = fit(dark, shape)
+			gain = fit(flat, shape)
+			if (gain is not None):
+				# Divide by the flat, normalised per channel so colours stay balanced
+				gain = gain.mean(axis=(0, 1), keepdims=True) / np.maximum(gain, 1e-3)
+				gain = gain.astype(np.float32)
+			if (offset is None and gain is None):
+				return None
+			return (offset, gain)
+		return self.library.cached(('masters', key, shape), load)
+
+	def apply(self, frame, key):
+		masters = self.masters(key, frame.shape)
+		if (masters is None):
+			return False
+		offset, gain = masters
+
+		if (frame.shape not in self.temp):
+			self.temp[frame.shape] = np.empty(frame.shape, dtype=np.float32)
+		temp = self.temp[frame.shape]
+		if (offset is not None):
+			np.subtract(frame, offset, out=temp, dtype=np.float32)
+		else:
+			np.copyto(temp, frame)
+		if (gain is not None):
+			temp *= gain
+		white = np.iinfo(frame.dtype).max
+		np.clip(temp, 0, white, out=temp)
+		# Calibrated in place, the raw frame is not needed any more
+		np.copyto(frame, temp, casting='unsafe')
+		return True
@@ -1,12 +1,25 @@
-from picamera import PiCamera
 from time import sleep
-from PIL import Image
+import time
+import json
 import argparse
+import functools
 import io
+import itertools
 import numpy as np
 from fractions import Fraction
 import datetime
 import os
+import mystack
+import mybayer
+import mywriter
+import mycalib
+import myhotpixel
+import myregister
+import mystats
+import mycatalog
+import myschedule
+import mybackend
+import mymetrics
 
 class Config:
 	def __init__(self, resolution = None, sensor_mode = None, exposure = None, iso = None, exposure_mode = None, rotation = None):
@@ -17,34 +30,272 @@ class Config:
 		self.exposure_mode = exposure_mode
 		self.rotation = rotation
 
+	def merge(self, config):
+		# Later settings win, unset ones keep what was there
+		for name, value in vars(config).items():
+			if (value is not None):
+				setattr(self, name, value)
+		return self
+
 class DefaultConfig(Config):
 	def __init__(self):
 		Config.__init__(self, (1920, 1080), 3, 0, 0, 'auto')
 
-class MyCamera:
-	camera = PiCamera()
+class FrameBuffers:
+	def __init__(self, count = 2, allocator = None):
+		self.count = count
+		self.allocator = allocator
+		self.buffers = []
+		self.index = 0
+
+	def clear(self):
+		if (self.allocator is not None):
+			for buffer in self.buffers:
+				self.allocator.free(buffer)
+		self.buffers = []
+
+	def set_count(self, count):
+		if (count != self.count):
+			self.clear()
+			self.count = count
+
+	def set_allocator(self, allocator):
+		self.clear()
+		self.allocator = allocator
+
+	def empty(self, shape, dtype = np.uint8):
+		if (self.allocator is not None):
+			return self.allocator.empty(shape, dtype)
+		return np.empty(shape, dtype)
+
+	def next(self, shape, dtype = np.uint8):
+		if (len(self.buffers) == 0 or
+			self.buffers[0].shape != shape or
+			self.buffers[0].dtype != dtype):
+			self.clear()
+			self.buffers = [self.empty(shape, dtype) for i in range(self.count)]
+			self.index = 0
+		buffer = self.buffers[self.index]
+		self.index = (self.index + 1) % self.count
+		return buffer
+
+class FrameOutput:
+	# File-like sink for capture_continuous, every frame lands in the next ring buffer
+	def __init__(self, buffers, shape):
+		self.buffers = buffers
+		self.shape = shape
+		self.buffer = None
+		self.offset = 0
+		self.size = None
+		self.resize = False
+
+	def next(self):
+		self.buffer = self.buffers.next(self.shape)
+		self.offset = 0
+
+	def write(self, data):
+		flat = self.buffer.reshape(-1)
+		data = np.frombuffer(data, dtype=np.uint8)
+		end = min(self.offset + data.size, flat.size)
+		flat[self.offset:end] = data[:end - self.offset]
+		self.offset += data.size
+		return data.size
+
+	def flush(self):
+		pass
+
+def read_gains(camera):
+	return {
+		'analog_gain': float(camera.analog_gain),
+		'digital_gain': float(camera.digital_gain),
+		'exposure_speed': int(camera.exposure_speed),
+		'awb_gains': [float(gain) for gain in camera.awb_gains],
+	}
+
+class GainSettler:
+	# Polls the automatic gains until they stop moving. Polls come quickly while
+	# they are moving and back off once they look settled
+	def __init__(self, camera, tolerance = 0.02, stable = 3, timeout = 30, interval = 0.05, max_interval = 1.0):
+		self.camera = camera
+		self.tolerance = tolerance
+		self.stable = stable
+		self.timeout = timeout
+		self.min_interval = interval
+		self.max_interval = max_interval
+		self.interval = interval
+		self.started = time.monotonic()
+		self.next = self.started
+		self.last = None
+		self.count = 0
+		self.done = False
+		self.settled = None
+
+	def read(self):
+		return read_gains(self.camera)
+
+	def close(self, old, new):
+		return abs(new - old) <= self.tolerance * max(abs(old), abs(new))
+
+	def converged(self, old, new):
+		if (new['analog_gain'] == 0 or new['exposure_speed'] == 0):
+			return False
+		for name in ['analog_gain', 'digital_gain', 'exposure_speed']:
+			if (not self.close(old[name], new[name])):
+				return False
+		return all(self.close(a, b) for a, b in zip(old['awb_gains'], new['awb_gains']))
+
+	def elapsed(self):
+		return time.monotonic() - self.started
+
+	def poll(self):
+		# Seconds until the next poll is due, None once settled or given up
+		now = time.monotonic()
+		if (self.done):
+			return None
+		if (now < self.next):
+			return self.next - now
+
+		values = self.read()
+		if (self.last is not None and self.converged(self.last, values)):
+			self.count += 1
+		else:
+			self.count = 0
+			self.interval = self.min_interval
+		self.last = values
+		print("Analog Gain: {analog_gain:.3f}, Digital Gain: {digital_gain:.3f}, Exposure: {exposure_speed}".format(**values))
+
+		if (self.count >= self.stable):
+			self.settled = values
+			self.done = True
+		elif (now - self.started > self.timeout):
+			print("Gains did not settle in {}s".format(self.timeout))
+			self.done = True
+		if (self.done):
+			return None
 
-	def __init__(self, mode='auto', exposure=0, iso=0):
+		# The gains cannot change faster than once a frame
+		frame_time = 1 / float(self.camera.framerate)
+		self.interval = min(max(self.interval * 1.5, frame_time), self.max_interval)
+		self.next = now + self.interval
+		return self.interval
+
+class GainCache:
+	# Settled gains by camera config, so a known config is locked without settling again
+	def __init__(self, path = os.path.expanduser('~/.mycamera/gains.json')):
+		self.path = path
+		self.gains = {}
+		if (os.path.exists(path)):
+			with open(path) as f:
+				self.gains = json.load(f)
+
+	def name(self, key):
+		(width, height), sensor_mode, exposure, iso = key
+		return "{}x{}_m{}_e{}_i{}".format(width, height, sensor_mode, exposure, iso)
+
+	def get(self, key):
+		return self.gains.get(self.name(key))
+
+	def put(self, key, settings):
+		self.gains[self.name(key)] = settings
+		os.makedirs(os.path.dirname(self.path), exist_ok=True)
+		mywriter.write_atomic(self.path, json.dumps(self.gains, indent=1).encode('utf-8'))
+
+class MyCamera:
+	def __init__(self, mode='auto', exposure=0, iso=0, buffers=2, preview=(960, 540), backend='picamera', path=None):
 		config = DefaultConfig()
 		config.exposure_mode = mode
 		config.exposure = exposure
 		config.iso = iso
 #		self.set_config(config)
+		self.buffers = FrameBuffers(buffers)
+		self.preview_buffers = FrameBuffers(buffers)
+		self.preview = preview
+		self.applied = Config()
+		self.stream = None
+		self.output = None
+		self.locked = False
+		self.unlocked = None
+		self.backend = backend
+		self.path = path
+		self.device = None
+
+	def open(self):
+		if (self.device is None):
+			self.device = mybackend.open_camera(self.backend, self.path)
+		return self.device
+
+	def close(self):
+		self.stop_stream()
+		if (self.device is not None):
+			self.device.close()
+			self.device = None
+
+	@property
+	def camera(self):
+		# The camera is opened on first use, importing this module does not touch the hardware
+		return self.open()
+
+	def set_buffers(self, count):
+		# Frames are handed out as views into a ring of buffers, so the ring
+		# must be deeper than the number of frames alive downstream
+		self.buffers.set_count(count)
+		self.preview_buffers.set_count(count)
+
+	def set_allocator(self, allocator):
+		# Lets frames be captured straight into shared memory
+		self.stop_stream()
+		self.buffers.set_allocator(allocator)
+		self.preview_buffers.set_allocator(allocator)
 
 	def config(self, config):
 		self.configure(config.mode, config.exposure, config.iso)
 
+	def changes(self, config):
+		changes = Config()
+		changed = False
+		for name, value in vars(config).items():
+			if (value is not None and value != getattr(self.applied, name)):
+				setattr(changes, name, value)
+				changed = True
+		if (changed):
+			return changes
+		return None
+
+	def framerate(self, exposure):
+		# Exposures that fit in a 30fps frame keep it, so they do not restart the camera
+		if (exposure is None or exposure * 30 <= 1000):
+			return 30
+		return Fraction(1000, exposure)
+
 	def set_config(self, config):
-		if (config.resolution is not None):
-			self.camera.resolution = config.resolution
+		config = self.changes(config)
+		if (config is None):
+			return False
+
+		framerate = None
+		if (config.exposure is not None and
+			self.framerate(config.exposure) != self.framerate(self.applied.exposure)):
+			framerate = self.framerate(config.exposure)
+
+		# Every one of these restarts the camera and cannot change under a running video port.
+		# They go first, with the stream stopped once for all of them
+		if (config.resolution is not None or
+			config.sensor_mode is not None or
+			framerate is not None):
+			self.stop_stream()
+
+		self.applied.merge(config)
+
 		if (config.sensor_mode is not None):
 			self.camera.sensor_mode = config.sensor_mode
-		if (config.exposure is not None):
-			framerate = 30
-			if (config.exposure > 0):
-				framerate = Fraction(1000, config.exposure)
+		if (config.resolution is not None):
+			self.camera.resolution = config.resolution
+		if (framerate is not None):
 			self.camera.framerate = framerate
-			shutter_speed = config.exposure * 1000
+		# The rest is applied to the running camera, the shutter speed after
+		# the framerate that bounds it
+		if (config.exposure is not None):
+			shutter_speed = int(config.exposure * 1000)
 			self.camera.shutter_speed = shutter_speed
 		if (config.iso is not None):
 			self.camera.iso = config.iso
@@ -52,6 +303,18 @@ class MyCamera:
 			self.camera.exposure_mode = config.exposure_mode
 		if (config.rotation is not None):
 			self.camera.rotation = config.rotation
+		return True
+
+	def gains(self):
+		# What the camera actually used, rather than what it was asked for
+		return read_gains(self.camera)
+
+	def key(self, frame=None):
+		# Everything a dark frame depends on, raw frames have the size of the sensor
+		resolution = tuple(self.camera.resolution)
+		if (frame is not None):
+			resolution = (frame.shape[1], frame.shape[0])
+		return (resolution, self.camera.sensor_mode, self.camera.shutter_speed // 1000, self.camera.iso)
 
 	def configure(self, mode, exposure, iso):
 		shutter_speed = exposure * 1000
@@ -75,47 +338,155 @@ class MyCamera:
 		self.camera.exposure_mode = mode
 #		self.camera.annotate_text = "Gain: {}, Exposure: {}".format(old_gain, old_speed)
 
-	def calibrate(self):
-		old_gain = None
-		old_speed = None
-		for i in range(30):
-			sleep(1)
-			new_a_gain = self.camera.analog_gain
-			new_d_gain = self.camera.digital_gain
-			new_speed = self.camera.exposure_speed
-			print("Analog Gain: {}, Digital Gain: {}, Exposure: {} ({})".format(new_a_gain, new_d_gain, new_speed, i))
-
-			if (old_gain == new_a_gain and
-				old_speed == new_speed and
-				not new_a_gain == 0 and
-				not new_speed == 0):
-				break
-			else:
-				old_gain = new_a_gain
-				old_speed = new_speed
-
-	def capture(self, file):
+	def lock_gains(self, settings):
+		# Through set_config like any other change, so what was applied stays known.
+		# The exposure is kept to the microsecond
+		if (not self.locked):
+			self.unlocked = Config(exposure = self.applied.exposure or 0, iso = self.applied.iso or 0)
+		config = Config(exposure = Fraction(settings['exposure_speed'], 1000), exposure_mode = 'off')
+		self.camera.awb_mode = 'off'
+		self.camera.awb_gains = tuple(settings['awb_gains'])
+		try:
+			self.camera.analog_gain = settings['analog_gain']
+			self.camera.digital_gain = settings['digital_gain']
+		except Exception:
+			# Older firmware only takes an ISO, the analog gain the AGC aims for
+			config.iso = int(round(settings['analog_gain'] * 100))
+		# Freezes the gains where they are
+		self.set_config(config)
+		self.locked = True
+
+	def unlock_gains(self):
+		if (self.locked):
+			self.camera.awb_mode = 'auto'
+			config = Config(exposure_mode = 'auto').merge(self.unlocked)
+			self.set_config(config)
+			self.locked = False
+
+	def start_settle(self, cache = None, refresh = False):
+		# A settler to poll, or None when the gains come from the cache. Refreshed,
+		# the gains are measured again and replace the ones in the cache
+		self.unlock_gains()
+		key = self.key()
+		if (cache is not None and not refresh and cache.get(key) is not None):
+			print("Gains from cache: {}".format(cache.name(key)))
+			self.lock_gains(cache.get(key))
+			return None
+		return GainSettler(self.camera)
+
+	def end_settle(self, settler, cache = None, lock = True):
+		if (settler.settled is None):
+			return False
+		print("Gains settled in {:.2f}s".format(settler.elapsed()))
+		if (cache is not None):
+			cache.put(self.key(), settler.settled)
+		if (lock):
+			self.lock_gains(settler.settled)
+		return True
+
+	def calibrate(self, cache = None, lock = False, refresh = False):
+		settler = self.start_settle(cache, refresh)
+		if (settler is None):
+			return True
+		interval = settler.poll()
+		while interval is not None:
+			sleep(interval)
+			interval = settler.poll()
+		return self.end_settle(settler, cache, lock)
+
+	def capture(self, file, format=None):
 		# Finally, capture an image with a 6s exposure. Due
 		# to mode switching on the still port, this will take
 		# longer than 6 seconds
 		a_gain = self.camera.analog_gain
 		d_gain = self.camera.digital_gain
 		speed = self.camera.exposure_speed
-		print("Saving {} ({}, {}, {})".format(file, a_gain, d_gain, speed), end='', flush=True)
+		name = file if isinstance(file, str) else format
+		print("Saving {} ({}, {}, {})".format(name, a_gain, d_gain, speed), end='', flush=True)
 		self.camera.annotate_text = "Analog Gain: {}, Digital Gain: {}, Exposure: {}".format(a_gain, d_gain, speed)
 		print('.', end='', flush=True)
 #		self.camera.PiCamera.CAPTURE_TIMEOUT = 300 #5min
-		self.camera.capture(file)
+		self.camera.capture(file, format=format)
 		print('.', end='', flush=True)
 #		self.camera.close()
 
 	def capture_image(self):
+		from PIL import Image
 		stream = io.BytesIO()
 		self.camera.capture(stream, format='png')
 #		self.camera.close()
 		stream.seek(0)
 		return Image.open(stream)
 
+	def capture_raw(self, demosaic=None):
+		# The JPEG comes with the sensor data appended, straight from the sensor
+		stream = io.BytesIO()
+		self.camera.capture(stream, format='jpeg', bayer=True)
+		bayer, order = mybayer.extract(stream.getvalue())
+		if (demosaic is not None):
+			bayer = mybayer.demosaic(bayer, order, demosaic)
+		# Left align the 10 bit values, so white is the top of the uint16 range
+		bayer <<= 6
+		return bayer
+
+	def buffer_shape(self, size, format):
+		width, height = size
+		# Unencoded captures are padded to a multiple of 32x16 pixels
+		pad_width = (width + 31) // 32 * 32
+		pad_height = (height + 15) // 16 * 16
+		if (format == 'yuv'):
+			# Y plane followed by the quarter size U and V planes, only Y is returned
+			return (pad_height * 3 // 2, pad_width)
+		return (pad_height, pad_width, 3)
+
+	def preview_size(self):
+		# Largest size that fits the preview and keeps the aspect ratio
+		width, height = self.camera.resolution
+		scale = min(self.preview[0] / width, self.preview[1] / height, 1)
+		return (int(width * scale), int(height * scale))
+
+	def capture_array(self, format='rgb', use_video_port=False, resize=False):
+		if (resize):
+			# Let the camera's resizer produce the preview, no full frame is read out
+			size = self.preview_size()
+			buffer = self.preview_buffers.next(self.buffer_shape(size, format))
+			self.camera.capture(buffer, format=format, use_video_port=use_video_port, resize=size)
+		else:
+			size = self.camera.resolution
+			buffer = self.buffers.next(self.buffer_shape(size, format))
+			# Splitter port 1 belongs to the preview stream
+			self.camera.capture(buffer, format=format, use_video_port=use_video_port, splitter_port=2)
+		width, height = size
+		return buffer[:height, :width]
+
+	def start_stream(self, format='rgb', resize=False):
+		self.stop_stream()
+		if (resize):
+			size = self.preview_size()
+			self.output = FrameOutput(self.preview_buffers, self.buffer_shape(size, format))
+			self.stream = self.camera.capture_continuous(self.output, format=format, use_video_port=True, resize=size, splitter_port=1)
+		else:
+			size = self.camera.resolution
+			self.output = FrameOutput(self.buffers, self.buffer_shape(size, format))
+			self.stream = self.camera.capture_continuous(self.output, format=format, use_video_port=True, splitter_port=1)
+		self.output.size = size
+		self.output.resize = resize
+
+	def stop_stream(self):
+		if (self.stream is not None):
+			# Closing the generator stops the video port encoder
+			self.stream.close()
+			self.stream = None
+			self.output = None
+
+	def capture_stream(self, format='rgb', resize=False):
+		if (self.stream is None or self.output.resize != resize):
+			self.start_stream(format, resize)
+		self.output.next()
+		next(self.stream)
+		width, height = self.output.size
+		return self.output.buffer[:height, :width]
+
 def parse_args():
 	parser = argparse.ArgumentParser(description="MyCamera console")
 	parser.add_argument('--file', '-f', help='Image name', default='test.jpg')
@@ -123,8 +494,30 @@ def parse_args():
 	parser.add_argument('--exposure', '-e', help='Exposure', type=int, default=0)
 	parser.add_argument('--iso', '-i', help='ISO', type=int, default=0)
 	parser.add_argument('--number', '-n', help='Number of images', type=int, default=1)
-	parser.add_argument('--delay', '-d', help='Delay between images', type=int, default=0)
-	return parser.parse_args()
+	parser.add_argument('--delay', '-d', help='Seconds from the start of one image to the next', type=float, default=0)
+	parser.add_argument('--missed', help='What to do with slots missed by slow captures', choices=myschedule.policies, default='skip')
+	parser.add_argument('--stack', '-s', help='Stack the images instead of saving each one', choices=sorted(mystack.stackers))
+	parser.add_argument('--depth', help='Bits per channel of the stacked image', type=int, choices=[8, 16], default=8)
+	parser.add_argument('--align', '-a', help='Align the frames on the first one before stacking them', choices=myregister.modes)
+	parser.add_argument('--raw', '-r', help='Use the raw bayer data', action='store_true')
+	parser.add_argument('--demosaic', help='Demosaic the raw bayer data', choices=sorted(mybayer.demosaics))
+	parser.add_argument('--calibrate', '-c', help='Subtract the master dark and divide by the master flat', action='store_true')
+	parser.add_argument('--hotpixels', help='Replace the hot pixels with the median of their neighbours', action='store_true')
+	parser.add_argument('--build', '-b', help='Build a master calibration frame or the hot pixel map instead', choices=mycalib.kinds)
+	parser.add_argument('--library', help='Calibration frame folder', default='/share/pics/calib')
+	parser.add_argument('--backend', help='Camera backend', choices=mybackend.backends, default='picamera')
+	parser.add_argument('--replay', help='Folder of images for the replay backend')
+	parser.add_argument('--auto-exposure', help='Meter a few frames first and adjust exposure and ISO between frames', action='store_true')
+	parser.add_argument('--max-exposure', help='Longest exposure in ms the auto exposure may use', type=int, default=6000)
+	parser.add_argument('--batch', help='Capture into memory and encode on all cores in this format', choices=['jpeg', 'png', 'tiff'])
+	parser.add_argument('--processes', '-p', help='Encoding processes of the batch mode, one per core by default', type=int)
+	parser.add_argument('--catalog', help='Catalog database of the captures, none by default')
+	parser.add_argument('--settle', help='Let the gains settle, or take them from the cache, and lock them', action='store_true')
+	parser.add_argument('--resettle', help='Let the gains settle even if cached, replace the cached ones and lock them', action='store_true')
+	args = parser.parse_args()
+	if (args.batch is not None and args.raw and args.batch != 'tiff'):
+		parser.error("raw frames are 16 bit, only --batch tiff keeps them")
+	return args
 
 def print_args(args):
 	print("File: {}".format(args.file))
@@ -132,14 +525,78 @@ def print_args(args):
 	print("Expo: {}".format(args.exposure))
 	print("Iso: {}".format(args.iso))
 	print("Number: {}".format(args.number))
-	print("Delay: {}".format(args.delay))
+	print("Delay: {} ({})".format(args.delay, args.missed))
+	print("Stack: {} ({} bit)".format(args.stack, args.depth))
+	print("Align: {}".format(args.align))
+	print("Raw: {} ({})".format(args.raw, args.demosaic))
+	print("Calibrate: {} ({})".format(args.calibrate, args.build))
+	print("Hot pixels: {}".format(args.hotpixels))
+	print("Auto exposure: {} (max {} ms)".format(args.auto_exposure, args.max_exposure))
+	print("Catalog: {}".format(args.catalog))
+	print("Batch: {} ({} processes)".format(args.batch, args.processes))
+	print("Settle: {} (resettle {})".format(args.settle, args.resettle))
+	print("Backend: {}".format(args.backend))
 	print()
 
+def capture_frame(my_camera, args):
+	if (args.raw):
+		return my_camera.capture_raw(args.demosaic)
+	return my_camera.capture_array()
+
+def expose(my_camera, controller, stats):
+	# Settings for the next frame from the stats of the last one, True while they change
+	resolution, sensor_mode, exposure, iso = my_camera.key()
+	if (exposure == 0):
+		exposure = max(1, my_camera.camera.exposure_speed // 1000)
+		iso = iso or int(round(my_camera.camera.analog_gain * 100))
+	settings = controller.update(stats, exposure, iso)
+	if (settings is None):
+		return False
+	my_camera.set_config(Config(exposure = settings[0], iso = settings[1]))
+	return True
+
+def meter(my_camera, args, controller, stats, frames = 5):
+	# Usually right after two or three frames
+	for i in range(frames):
+		print("Metering {}: {}".format(i, stats.update(capture_frame(my_camera, args))))
+		if (not expose(my_camera, controller, stats)):
+			break
+
+def raw_format(frame):
+	# Bayer data as is, a 16 bit colour image once demosaiced
+	if (frame.dtype == np.uint8):
+		return 'png'
+	return 'npy' if frame.ndim == 2 else 'ppm'
+
+def save_raw(writer, basename, frame, done = None):
+	return writer.write(frame, basename, raw_format(frame), done=done)
+
+def save_jpeg(writer, my_camera, file, done = None):
+	# Encoded by the camera, written while the next image is exposed
+	stream = io.BytesIO()
+	my_camera.capture(stream, 'jpeg')
+	return writer.write_encoded(stream.getvalue(), file, done)
+
 def main():
 	args = parse_args()
 	print_args(args)
 
-	my_camera = MyCamera(args.mode, args.exposure, args.iso)
+	my_camera = MyCamera(args.mode, args.exposure, args.iso, backend=args.backend, path=args.replay)
+	my_camera.open()
+	library = mycalib.CalibrationLibrary(args.library)
+
+	if (args.settle or args.resettle):
+		started = time.monotonic()
+		my_camera.calibrate(GainCache(), lock=True, refresh=args.resettle)
+		print("Ready in {:.2f}s".format(time.monotonic() - started))
+
+	if (args.build is not None):
+		# Frames are folded into the master as they arrive. Keyed on the frames,
+		# raw ones have the size of the sensor and not the one set on the camera
+		frames = (capture_frame(my_camera, args) for i in range(args.number))
+		first = next(frames)
+		library.build(args.build, my_camera.key(first), itertools.chain([first], frames))
+		return
 
 	now = datetime.datetime.now()
 	timestamp = now.strftime('%Y-%m-%d_%H-%M-%S')
@@ -149,12 +606,115 @@ def main():
 	os.makedirs(path)
 	os.chdir(path)
 
+	stacker = None
+	if (args.stack is not None):
+		stacker = mystack.create(args.stack)
+	registration = None
+	if (args.stack is not None and args.align is not None):
+		registration = myregister.Registration(args.align)
+
+	calibrator = None
+	uncalibrated = mymetrics.Counter()
+	if (args.calibrate):
+		calibrator = mycalib.Calibrator(library)
+	corrector = None
+	if (args.hotpixels):
+		corrector = myhotpixel.HotPixelCorrector(library)
+
+	stats = None
+	controller = None
+	if (args.auto_exposure):
+		stats = mystats.FrameStats()
+		controller = mystats.ExposureController(gamma = 1.0 if args.raw else 2.2, max_exposure = args.max_exposure)
+		meter(my_camera, args, controller, stats)
+
+	def next_frame():
+		frame = capture_frame(my_camera, args)
+		if (controller is not None):
+			# Measured before calibration, on what the sensor saw
+			stats.update(frame)
+			expose(my_camera, controller, stats)
+		if (calibrator is not None and not calibrator.apply(frame, my_camera.key(frame))):
+			uncalibrated.inc()
+			if (uncalibrated.value == 1):
+				print("No master for {} in '{}'".format(my_camera.key(frame), library.path))
+		if (corrector is not None):
+			corrector.apply(frame, my_camera.key(frame))
+		return frame
+
+	catalog = None
+	if (args.catalog):
+		catalog = mycatalog.Catalog(args.catalog)
+		catalog.start()
+
+	def catalog_record(path, frame = None):
+		stats = None if frame is None else mystats.FrameStats().update(frame).summary()
+		return mycatalog.record(path, my_camera.key(frame), my_camera.gains(), stats, 'mycamera')
+
+	def catalog_done(path, frame = None):
+		# Catalogued once the file is in place
+		if (catalog is None):
+			return None
+		return functools.partial(catalog.add, catalog_record(path, frame))
+
+	encoder = None
+	if (args.batch is not None and stacker is None):
+		# Frames are captured straight into the encoder's shared buffers
+		encoder = mywriter.BatchEncoder(args.batch, args.processes)
+		my_camera.set_allocator(encoder.arrays)
+		my_camera.set_buffers(encoder.count)
+
+	writer = mywriter.FrameWriter()
+	writer.start()
+	schedule = myschedule.Schedule(args.delay, args.missed)
+	key = None
+
 	for i in range(args.number):
 		file = args.file.replace(".", "_{}_{}.".format(args.exposure, i), 1)
-		my_camera.capture(file)
-		if args.delay > 0:
-			sleep(args.delay)
-			print('.')
+		schedule.wait()
+		if (stacker is not None):
+			# Fold each frame in as it arrives, only the accumulators are kept
+			print("Stacking {}".format(i), end='', flush=True)
+			frame = next_frame()
+			if (registration is not None):
+				frame = registration.align(frame)
+			stacker.add(frame)
+			key = my_camera.key(frame)
+			print('.', end='', flush=True)
+		elif (encoder is not None):
+			encoder.wait()
+			frame = next_frame()
+			path = file.rsplit('.', 1)[0] + mywriter.extensions[args.batch]
+			encoder.submit(frame, path, catalog_done(path, frame))
+		elif (args.raw or calibrator is not None or corrector is not None):
+			frame = next_frame()
+			basename = file.rsplit('.', 1)[0]
+			path = basename + mywriter.extensions[raw_format(frame)]
+			save_raw(writer, basename, frame, catalog_done(path, frame))
+		else:
+			save_jpeg(writer, my_camera, file, catalog_done(file))
+		if (i == 0):
+			print("First image after {:.2f}s".format(mymetrics.uptime()))
+
+	if (encoder is not None):
+		encoder.close()
+	writer.close()
+	my_camera.close()
+	if (args.delay > 0):
+		jitter = schedule.jitter.snapshot()
+		print("Jitter: mean {mean:.1f} ms, p99 {p99:.1f} ms, max {max:.1f} ms".format(**jitter))
+	if (uncalibrated.value > 0):
+		print("Not calibrated: {} of {} frames".format(uncalibrated.value, args.number))
+
+	if (stacker is not None):
+		print()
+		file = args.file.replace(".", "_{}_{}.".format(args.exposure, args.stack), 1)
+		file = mystack.save(stacker, file, args.depth)
+		if (catalog is not None):
+			catalog.add(mycatalog.record(file, key, source = 'stack'))
+
+	if (catalog is not None):
+		catalog.close()
 
 if __name__ == "__main__":
 	main()
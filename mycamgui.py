@@ -2,12 +2,18 @@ import tkinter as tk
 from tkinter import ttk
 from PIL import Image, ImageTk
 from mycamera import MyCamera, Config
+from mymetrics import Metrics
+from mycalib import CalibrationLibrary
+from mymotion import load_mask
+from mypipeline import LiveUpdater, Display
+from mystream import StreamServer
+from myring import FrameRing
+from mycatalog import Catalog
+import mybackend
 import datetime
 import threading
-import time
-import queue
-import enum
-import sys
+import argparse
+import math
 import numpy as np
 
 def trace(*args):
@@ -15,294 +21,62 @@ def trace(*args):
 	timestamp = now.strftime("%Y%m%d_%H%M%S")
 	print("{} {}".format(timestamp, *args))
 
-def timing(f):
-	def wrap(*args):
-#		print("{:<32} +".format(f.__qualname__))
-		t1 = time.time()
-		ret = f(*args)
-		t2 = time.time()
-		print("{:<32} - {:>6.0f}".format(f.__qualname__, (t2 - t1)*1000))
-		return ret
-	return wrap
-
-class LiveUpdate(enum.Enum):
-	PAUSE = 0
-	RUN   = 1
-	ONCE  = 2
-	EXIT  = 3
-
-class Display(enum.Enum):
-	NOW  = 0
-	AVG  = 1
-	DIFF = 2
-
-class LiveUpdater:
-	class WorkItem:
-		pass
-
-	class Worker(threading.Thread):
-		def __init__(self, in_q = None, out_q = None):
-			threading.Thread.__init__(self)
-			self.in_q = in_q
-			self.out_q = out_q
-
-		def get(self):
-			if (self.in_q is not None):
-				return self.in_q.get()
-			return None
-
-		def work(self, item):
-			return item
-
-		def run(self):
-			while True:
-				item = self.get()
-
-				if (item is not None):
-					item = self.work(item)
-
-				if (self.in_q is not None):
-					self.in_q.task_done()
-
-				if (self.out_q is not None):
-					self.out_q.put(item)
-
-				if (item is None):
-					print("Exit Worker")
-					break
-
-	class CaptureWorker(Worker):
-		def __init__(self, mycam, out_q):
-			LiveUpdater.Worker.__init__(self, None, out_q)
-			self.mycam = mycam
-			self.num = 0
-			self.cv = threading.Condition()
-			self.config = None
-			self.state = LiveUpdate.PAUSE
-
-		def set_config(self, config):
-			print("Set config: {}".format(config))
-			with self.cv:
-				self.config = config
-				self.cv.notify()
-
-		def set_state(self, state):
-			print("Set state: {}".format(state))
-			with self.cv:
-				self.state = state
-				self.cv.notify()
-
-		def get(self):
-			with self.cv:
-				while self.state is LiveUpdate.PAUSE:
-					self.cv.wait()
-				if (self.state is LiveUpdate.EXIT):
-					return None
-				if (self.state is LiveUpdate.ONCE):
-					self.set_state(LiveUpdate.PAUSE)
-
-			item = LiveUpdater.WorkItem()
-			item.config = self.config
-			self.config = None
-#			if (self.config is not None):
-#				item.config = self.config
-#				self.config = None
-#			else:
-#				item.config = None
-
-			return item
-
-		@timing
-		def work(self, item):
-			if (item.config is not None):
-				self.mycam.set_config(item.config)
-
-#			print("Capture A")
-			try:
-#				self.mycam.capture("temp.jpg")
-				item.image = self.mycam.capture_image()
-			except:
-#				print("Capture X:", sys.exc_info()[0])
-				item.image = None
-#			print("Capture B")
-			return item
-
-	class WaitingCaptureWorker(CaptureWorker):
-		def __init__(self, mycam, out_q, delay):
-			LiveUpdater.CaptureWorker.__init__(self, mycam, out_q)
-			self.delay = delay
-			self.time_now = time.time()
-
-		def get(self):
-			last_time = self.time_now
-			self.time_now = time.time()
-			time_wait = last_time + self.delay - self.time_now
-			if time_wait > 0:
-				print("Waiting {}s".format(time_wait))
-				with self.cv:
-					self.cv.wait(timeout=time_wait)
-			return LiveUpdater.CaptureWorker.get(self)
-
-	class ScaleWorker(Worker):
-		def __init__(self, in_q, out_q):
-			LiveUpdater.Worker.__init__(self, in_q, out_q)
-
-		@timing
-		def work(self, item):
-			if (item.image is not None):
-				size = (960, 540)
-				item.thumbnail = item.image.copy()
-				item.thumbnail.thumbnail(size)
-			return item
-
-	class AverageWorker(Worker):
-		def __init__(self, in_q, out_q = None):
-			LiveUpdater.Worker.__init__(self, in_q, out_q)
-			self.avg = None
-
-		def calc_average(self, item):
-			if (self.avg is None):
-				print("No previous average")
-				self.avg = item.thumbnail
-			self.avg = Image.blend(self.avg, item.thumbnail, 0.3)
-
-		@timing
-		def work(self, item):
-			if (item.thumbnail is not None):
-				self.calc_average(item)
-			item.avg = self.avg
-
-			return item
-
-	class DiffWorker(Worker):
-		def __init__(self, in_q, out_q = None):
-			LiveUpdater.Worker.__init__(self, in_q, out_q)
-
-		def calc_diff(self, item):
-			now = (np.array(item.thumbnail.convert('L'))).astype(np.int)
-			avg = (np.array(item.avg.convert('L'))).astype(np.int)
-			diff = (now - avg)*10
-			mean = diff.mean()
-			print("Mean: {}".format(mean))
-			item.diff = Image.fromarray(np.absolute(diff-mean)+127)
-
-		@timing
-		def work(self, item):
-			if (item.thumbnail is not None) and (item.avg is not None):
-				self.calc_diff(item)
-
-			return item
-
-	class DisplayWorker(Worker):
-		def __init__(self, mycanvas, in_q, out_q = None):
-			LiveUpdater.Worker.__init__(self, in_q, out_q)
-			self.mycanvas = mycanvas
-			self.display = Display.NOW
-
-		def get_timestamp(self):
-			now = datetime.datetime.now()
-			timestamp = now.strftime("%Y%m%d_%H%M%S")
-			return timestamp
-
-		def set_display(self, display):
-			self.display = display
-
-		@timing
-		def work(self, item):
-			image = None
-			if (self.display is Display.NOW):
-				image = item.thumbnail
-			if (self.display is Display.AVG):
-				image = item.avg
-			if (self.display is Display.DIFF):
-				image = item.diff
-
-			if (image is not None):
-				self.mycanvas.set_image(image)
-
-				item.timestamp = self.get_timestamp()
-				self.mycanvas.set_time(item.timestamp)
-			else:
-				print("No display")
-
-			return item
-
-	class AutosaveWorker(Worker):
-		def __init__(self, mycanvas, in_q, out_q = None):
-			LiveUpdater.Worker.__init__(self, in_q, out_q)
-			self.mycanvas = mycanvas
-			self.state = False
-
-		def set_state(self, state):
-			print("Set autosave: {}".format(state))
-			self.state = state
-
-		@timing
-		def work(self, item):
-			if (self.state is True and
-				item.image is not None):
-				print("Saving...")
-				item.filename = "{}.png".format(item.timestamp)
-				item.image.save(item.filename)
-				print("Save '{}'".format(item.filename))
-			return item
-
-	def __init__(self, mycam, mycanvas):
-		self.aq = queue.Queue(1)
-		self.bq = queue.Queue(1)
-		self.cq = queue.Queue(1)
-		self.dq = queue.Queue(1)
-		self.eq = queue.Queue(1)
-
-#		self.aw = self.WaitingCaptureWorker(mycam, self.aq, 60)
-		self.aw = self.CaptureWorker(mycam, self.aq)
-		self.bw = self.ScaleWorker(self.aq, self.bq)
-		self.cw = self.AverageWorker(self.bq, self.cq)
-		self.dw = self.DiffWorker(self.cq, self.dq)
-		self.ew = self.DisplayWorker(mycanvas, self.dq, self.eq)
-		self.fw = self.AutosaveWorker(mycanvas, self.eq)
-
-	def start(self):
-		self.aw.start()
-		self.bw.start()
-		self.cw.start()
-		self.dw.start()
-		self.ew.start()
-		self.fw.start()
-
-	def join(self):
-		self.aw.set_state(LiveUpdate.EXIT)
-
-		self.aq.join()
-		self.bq.join()
-		self.cq.join()
-		self.dq.join()
-		self.eq.join()
-
-		self.aw.join()
-		self.bw.join()
-		self.cw.join()
-		self.dw.join()
-		self.ew.join()
-		self.fw.join()
-
-	def set_display(self, display):
-		self.ew.set_display(display)
-
-	def set_config(self, config):
-		self.aw.set_config(config)
-
-	def once(self):
-		self.aw.set_state(LiveUpdate.ONCE)
-
-	def live(self, status):
-		if (status):
-			self.aw.set_state(LiveUpdate.RUN)
-		else:
-			self.aw.set_state(LiveUpdate.PAUSE)
-
-	def autosave(self, status):
-		self.fw.set_state(status)
+class FrameSlot:
+	# Triple buffer between a worker and the Tk main loop. The worker fills the
+	# back buffer and swaps it in as pending, Tk swaps pending to the front.
+	# Only the newest frame is ever painted. Every buffer holds the displayed
+	# frame and optionally the full resolution frame it came from
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.back = [None, None, False]
+		self.pending = [None, None, False]
+		self.front = [None, None, False]
+		self.timestamp = None
+		self.fresh = False
+		self.skipped = Metrics().counter("skipped")
+
+	def set_metrics(self, metrics, name):
+		self.skipped = metrics.counter("{}.skipped".format(name))
+
+	def reuse(self, buffer, array):
+		if (buffer is None or buffer.shape != array.shape or buffer.dtype != array.dtype):
+			buffer = np.empty(array.shape, array.dtype)
+		np.copyto(buffer, array)
+		return buffer
+
+	def put(self, array, timestamp, full = None):
+		preview, large, has_full = self.back
+		preview = self.reuse(preview, array)
+		if (full is not None):
+			large = self.reuse(large, full)
+		with self.lock:
+			if (self.fresh):
+				# Superseded before Tk got to paint it
+				self.skipped.inc()
+			self.back, self.pending = self.pending, [preview, large, full is not None]
+			self.timestamp = timestamp
+			self.fresh = True
+
+	def get(self):
+		with self.lock:
+			if (not self.fresh):
+				return None, None, None
+			self.front, self.pending = self.pending, self.front
+			self.fresh = False
+			preview, large, has_full = self.front
+			return preview, large if has_full else None, self.timestamp
+
+class ImagePyramid:
+	# Halved copies of a frame, each level only built when the loupe first needs it
+	def __init__(self, image, max_level = 4):
+		self.levels = [image]
+		self.max_level = max_level
+
+	def level(self, level):
+		level = min(level, self.max_level)
+		while len(self.levels) <= level:
+			self.levels.append(self.levels[-1].reduce(2))
+		return self.levels[level]
 
 class MyCamMenu(tk.Frame):
 	def __init__(self, master, app):
@@ -319,15 +93,24 @@ class MyCamMenu(tk.Frame):
 		self.widget3 = self.build_labelframe("Capture", grid = {"sticky":"EW"})
 		self.widget3.x = self.build_checkbox("Live", root = self.widget3, command = app.cmd_live)
 		self.widget3.y = self.build_button("Now", app.cmd_capture, root = self.widget3, grid = {"column":1, "row":0, "sticky":"E"})
+		self.widget3.z = self.build_checkbox("Dark/Flat", root = self.widget3, command = app.cmd_darks, grid = {"columnspan":2, "sticky":"W"})
+		self.widget3.w = self.build_checkbox("Hot pixels", root = self.widget3, command = app.cmd_hotpixels, grid = {"row":2, "sticky":"W"})
+		self.widget3.v = self.build_button("Learn", app.cmd_learn, root = self.widget3, grid = {"column":1, "row":2, "sticky":"E"})
 		self.widget4 = self.build_labelframe("Save", grid = {"sticky":"EW"})
 		self.widget4.x = self.build_checkbox("Auto", root = self.widget4, command = app.cmd_autosave)
 		self.widget4.y = self.build_button("Now", app.cmd_save, root = self.widget4, grid = {"column":1, "row":0, "sticky":"E"})
+		self.widget4.z = self.build_combo(["png", "tiff", "ppm", "npy", "jpeg"], root = self.widget4, command = app.cmd_format, grid = {"columnspan":2})
+		self.widget4.w = self.build_checkbox("On motion", root = self.widget4, command = app.cmd_motion, grid = {"columnspan":2, "sticky":"W"})
+		self.widget4.v = self.build_button("Event", app.cmd_event, root = self.widget4, grid = {"columnspan":2})
+		self.widgetB = self.build_labelframe("Metrics", grid = {"sticky":"EW"})
+		self.widgetB.x = self.build_checkbox("Show", root = self.widgetB, command = app.cmd_metrics)
 		self.widget5 = self.build_label("Settings", grid = {"columnspan":1})
 #		self.widget6 = self.build_labelframe("Mode")
 #		self.widget6.x = self.build_checkbox("Default", root = self.widget6, command = app.cmd_mode_default)
 #		self.widget6.y = self.build_scale(root = self.widget6, command = app.cmd_mode_value, grid = {"column":1, "row":0, "sticky":"E"})
 		self.widget6 = self.build_labelframeY("Mode", app.cmd_mode_default, app.cmd_mode_value)
 		self.widget7 = self.build_labelframeY("Exposure", app.cmd_exp_default, app.cmd_exp_value)
+		self.widget7.z = self.build_checkbox("Auto", root = self.widget7, command = app.cmd_exp_auto, grid = {"columnspan":2, "sticky":"W"})
 		self.widgetA = self.build_labelframe("Rotation", grid = {"sticky":"EW"})
 		self.widgetA.x = self.build_combo(["0", "90", "180", "270"], root = self.widgetA, command = app.cmd_rotation)
 		self.widget8 = self.build_labelframe("ISO")
@@ -412,16 +195,26 @@ class MyCamCanvas(tk.Canvas):
 
 		self.can_image = self.create_image((0, 0), anchor=tk.NW)
 		self.pil_image = None
+		self.image = None
+		self.writer = None
 
 		self.can_zoom = self.create_image((0, 0))
+		self.zoom = None
+		self.pyramid = None
 		self.zoom_pos = (0, 0)
 		self.zoom_level = 0
 
+		self.slot = FrameSlot()
+		self.interval = 20
+		self.after(self.interval, self.poll_frame)
+
 		self.can_time = self.create_text((20, 20), anchor=tk.NW, fill="white")
 		self.timestamp = "now"
 
+		self.can_stats = self.create_text((20, 40), anchor=tk.NW, fill="yellow", font="TkFixedFont")
+
 	def set_zoom(self):
-		if self.pil_image is not None:
+		if self.pyramid is not None:
 			def pw2pp(pos, size):
 				return (pos[0]-size[0]/2, pos[1]-size[1]/2,
 						pos[0]+size[0]/2, pos[1]+size[1]/2)
@@ -436,10 +229,16 @@ class MyCamCanvas(tk.Canvas):
 			size = (200, 200)
 			zoom_factor = pow(2, self.zoom_level/2)
 			zoom = (size[0]/zoom_factor, size[1]/zoom_factor)
-			img = self.pil_image.crop(pw2pp(self.zoom_pos, zoom))
+			# Source pixels per canvas pixel, more than one for a full resolution frame
+			scale = self.pyramid.levels[0].width / self.pil_image.width
+			# Served from the smallest level that still has a pixel for every loupe pixel
+			level = max(0, int(math.log2(max(scale / zoom_factor, 1))))
+			image = self.pyramid.level(level)
+			factor = image.width / self.pil_image.width
+			pos = (self.zoom_pos[0]*factor, self.zoom_pos[1]*factor)
+			img = image.crop(pw2pp(pos, (zoom[0]*factor, zoom[1]*factor)))
 			img = img.resize(size)
-			self.zoom = ImageTk.PhotoImage(img)
-			self.itemconfig(self.can_zoom, image=self.zoom)
+			self.zoom = self.paste(self.can_zoom, self.zoom, img)
 
 	def on_click(self, event):
 		self.zoom_pos = (event.x, event.y)
@@ -456,27 +255,60 @@ class MyCamCanvas(tk.Canvas):
 		self.zoom_level = sorted([0, self.zoom_level + delta(event), 8])[1]
 		self.set_zoom()
 
-	def set_image(self, pil_image):
+	def paste(self, item, photo, pil_image):
+		# Tk images are only created when the size changes, otherwise the pixels are pasted in
+		if (photo is None or (photo.width(), photo.height()) != pil_image.size):
+			photo = ImageTk.PhotoImage(pil_image)
+			self.itemconfig(item, image=photo)
+		else:
+			photo.paste(pil_image)
+		return photo
+
+	def set_image(self, pil_image, full = None):
 		self.pil_image = pil_image
-		self.image = ImageTk.PhotoImage(pil_image)
-		self.itemconfig(self.can_image, image=self.image)
+		self.image = self.paste(self.can_image, self.image, pil_image)
+		if (full is None):
+			full = pil_image
+		self.pyramid = ImagePyramid(full)
 
 		self.set_zoom()
 
+	def post_frame(self, array, timestamp, full = None):
+		# Called from the pipeline, only copies into the slot
+		self.slot.put(array, timestamp, full)
+
+	def poll_frame(self):
+		array, full, timestamp = self.slot.get()
+		if (array is not None):
+			# The front buffer stays put until the next frame is taken
+			if (full is not None):
+				full = Image.fromarray(full)
+			self.set_image(Image.fromarray(array), full)
+			self.set_time(timestamp)
+		self.after(self.interval, self.poll_frame)
+
+	def set_metrics(self, metrics):
+		self.slot.set_metrics(metrics, "display")
+
 	def set_time(self, timestamp):
 		self.timestamp = timestamp
 		self.itemconfig(self.can_time, text=self.timestamp)
 
+	def set_stats(self, text):
+		self.itemconfig(self.can_stats, text=text)
+
+	def set_writer(self, writer):
+		self.writer = writer
+
 	def save(self):
 		if self.pil_image is not None:
-			filename = "{}.png".format(self.timestamp)
-			self.pil_image.save(filename)
-			print("Save '{}'".format(filename))
+			# The displayed frame's buffer gets reused before the writer is done
+			self.writer.write(self.pil_image.copy(), self.timestamp)
 		else:
 			print("No image")
 
 class MainApplication(tk.Frame):
-	def __init__(self, master, mycam):
+	def __init__(self, master, mycam, metrics = None, processes = 0, library = None):
 		tk.Frame.__init__(self, master)
 		self.mycam = mycam
 
@@ -488,8 +320,14 @@ class MainApplication(tk.Frame):
 		tk.Grid.columnconfigure(self, 1, weight=1)
 		tk.Grid.rowconfigure(self, 0, weight=1)
 
-		self.updater = LiveUpdater(self.mycam, self.canvas)
+		self.updater = LiveUpdater(self.mycam, self.canvas, processes = processes, library = library)
+		if (metrics is not None):
+			self.updater.export_csv(metrics)
 		self.updater.start()
+		self.canvas.set_writer(self.updater.writer)
+		self.canvas.set_metrics(self.updater.metrics)
+		self.display = Display.NOW
+		self.show_metrics = False
 
 	def cmd_test(self):
 		print("Test")
@@ -497,13 +335,15 @@ class MainApplication(tk.Frame):
 	def cmd_display(self, display):
 		print("Display {}".format(display))
 		if (display == "Now"):
-			self.updater.set_display(Display.NOW)
+			self.display = Display.NOW
 		elif (display == "Avg"):
-			self.updater.set_display(Display.AVG)
+			self.display = Display.AVG
 		elif (display == "Diff"):
-			self.updater.set_display(Display.DIFF)
+			self.display = Display.DIFF
 		else:
 			print("Unknown")
+			return
+		self.updater.set_display(self.display)
 
 	def cmd_resolution(self, size):
 		config = Config()
@@ -527,7 +367,9 @@ class MainApplication(tk.Frame):
 		self.updater.set_config(config)
 
 	def cmd_calibrate(self):
-		self.mycam.calibrate()
+		# Settles on the capture thread, the GUI stays responsive. Gains that came
+		# from the cache are measured anew on the next press
+		self.updater.settle()
 
 	def cmd_capture(self):
 		self.updater.once()
@@ -542,8 +384,40 @@ class MainApplication(tk.Frame):
 		else:
 			self.updater.live(False)
 
+	def cmd_darks(self):
+		darks = self.menu.widget3.z.var.get()
+		self.updater.calibrate(darks > 0)
+
+	def cmd_hotpixels(self):
+		hot = self.menu.widget3.w.var.get()
+		self.updater.hotpixels(hot > 0)
+
+	def cmd_learn(self):
+		# Learns from the live frames, hot pixels stay put while the scene moves
+		self.updater.learn_hotpixels()
+
 	def cmd_save(self):
-		self.canvas.save()
+		if (self.display is Display.NOW):
+			# Grab a full resolution frame rather than the preview on screen
+			self.updater.save()
+		else:
+			self.canvas.save()
+
+	def cmd_metrics(self):
+		self.show_metrics = self.menu.widgetB.x.var.get() > 0
+		if (self.show_metrics):
+			self.update_metrics()
+		else:
+			self.canvas.set_stats("")
+
+	def update_metrics(self):
+		# Polled from the Tk main loop, the pipeline threads never touch it
+		if (self.show_metrics):
+			self.canvas.set_stats(self.updater.metrics.format())
+			self.after(1000, self.update_metrics)
+
+	def cmd_format(self, format):
+		self.updater.set_format(format)
 
 	def cmd_autosave(self):
 		auto = self.menu.widget4.x.var.get()
@@ -552,6 +426,14 @@ class MainApplication(tk.Frame):
 		else:
 			self.updater.autosave(False)
 
+	def cmd_motion(self):
+		motion = self.menu.widget4.w.var.get()
+		self.updater.autosave_motion(motion > 0)
+
+	def cmd_event(self):
+		# Exports the frames around now from the ring
+		self.updater.record_event()
+
 	def cmd_mode_default(self):
 		mode = self.menu.widget6.x.var.get()
 		print("X {}".format(mode))
@@ -570,12 +452,17 @@ class MainApplication(tk.Frame):
 			rot = 270
 
 		config = Config(rotation = rot)
-		self.mycam.set_config(config)
+		self.updater.set_config(config)
 
 	def cmd_exp_default(self):
 		exp = self.menu.widget7.x.var.get()
 		print("Exp {}".format(exp))
 
+	def cmd_exp_auto(self):
+		# Exposure and ISO follow the stats of the live frames
+		auto = self.menu.widget7.z.var.get()
+		self.updater.auto_exposure(auto > 0)
+
 	def cmd_exp_value(self, value):
 		print("Exp val: {}".format(value))
 
@@ -584,19 +471,25 @@ class MainApplication(tk.Frame):
 		print("ISO {}".format(iso))
 		if (iso != 0):
 			config = Config(iso = 0)
-			self.mycam.set_config(config)
+			self.updater.set_config(config)
 
 	def cmd_iso_value(self, value):
 		self.menu.widget8.x.deselect()
 
 		config = Config(iso = int(value))
-		self.mycam.set_config(config)
+		self.updater.set_config(config)
 		print("ISO {}".format(value))
 
 	def cmd_delay_default(self):
-		print("Delay default")
+		delay = self.menu.widget9.x.var.get()
+		print("Delay default {}".format(delay))
+		if (delay != 0):
+			self.updater.set_delay(0)
 
 	def cmd_delay_value(self, value):
+		self.menu.widget9.x.deselect()
+
+		self.updater.set_delay(float(value))
 		print("Delay value: {}".format(value))
 
 	def cmd_exit(self):
@@ -607,13 +500,48 @@ class MainApplication(tk.Frame):
 		print("Join LiveUpdater")
 		self.updater.join()
 
+def parse_args():
+	parser = argparse.ArgumentParser(description="MyCamera GUI")
+	parser.add_argument('--metrics', help='Write pipeline metrics to a CSV file')
+	parser.add_argument('--processes', '-p', help='Run the heavy stages in a pool of processes', type=int, default=0)
+	parser.add_argument('--library', help='Calibration frame folder', default='/share/pics/calib')
+	parser.add_argument('--mask', help='Motion mask image, only white areas are watched')
+	parser.add_argument('--backend', help='Camera backend', choices=mybackend.backends, default='picamera')
+	parser.add_argument('--replay', help='Folder of images for the replay backend')
+	parser.add_argument('--stream', help='Also serve the live view as MJPEG on this port', type=int)
+	parser.add_argument('--ring', help='Keep this many recent frames on disk for event exports', type=int, default=0)
+	parser.add_argument('--ring-path', help='Folder of the frame ring', default='/share/pics/ring')
+	parser.add_argument('--catalog', help='Catalog database of the saved frames, none by default')
+	return parser.parse_args()
+
 def main():
-	mycam = MyCamera('auto', 0)
+	args = parse_args()
+	mycam = MyCamera('auto', 0, backend=args.backend, path=args.replay)
+	mycam.open()
 	root = tk.Tk()
-	app = MainApplication(root, mycam)
+	app = MainApplication(root, mycam, args.metrics, args.processes, CalibrationLibrary(args.library))
+	if (args.mask is not None):
+		app.updater.set_mask(load_mask(args.mask))
+	if (args.ring > 0):
+		app.updater.set_ring(FrameRing(args.ring_path, args.ring, metrics=app.updater.metrics))
+	catalog = None
+	if (args.catalog):
+		catalog = Catalog(args.catalog)
+		catalog.start()
+		app.updater.set_catalog(catalog)
+	server = None
+	if (args.stream is not None):
+		server = StreamServer(port=args.stream, metrics=app.updater.metrics)
+		app.updater.set_server(server)
+		server.start()
 	app.pack()
 	root.mainloop()
 	app.join_updater()
+	if (catalog is not None):
+		catalog.close()
+	if (server is not None):
+		server.stop()
+	mycam.close()
 
 if __name__ == "__main__":
 	main()
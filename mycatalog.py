@@ -0,0 +1,177 @@
+import argparse
+import datetime
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+
+columns = ['path', 'time', 'width', 'height', 'sensor_mode', 'exposure', 'iso', 'exposure_speed',
+	'analog_gain', 'digital_gain', 'mean', 'p99', 'clipped', 'source']
+
+schema = """
+CREATE TABLE IF NOT EXISTS captures (
+	id INTEGER PRIMARY KEY,
+	path TEXT NOT NULL,
+	time REAL NOT NULL,
+	width INTEGER,
+	height INTEGER,
+	sensor_mode INTEGER,
+	exposure INTEGER,
+	iso INTEGER,
+	exposure_speed INTEGER,
+	analog_gain REAL,
+	digital_gain REAL,
+	mean REAL,
+	p99 REAL,
+	clipped REAL,
+	source TEXT
+);
+CREATE INDEX IF NOT EXISTS captures_time ON captures (time);
+CREATE INDEX IF NOT EXISTS captures_settings ON captures (exposure, iso, time);
+CREATE INDEX IF NOT EXISTS captures_path ON captures (path);
+"""
+
+def record(path, key, gains = None, stats = None, source = None):
+	# One row. exposure is the ms asked for, 0 when it was left to the camera, exposure_speed the us it used
+	(width, height), sensor_mode, exposure, iso = key
+	gains = gains or {}
+	stats = stats or {}
+	return {
+		'path': os.path.abspath(path),
+		'time': time.time(),
+		'width': width,
+		'height': height,
+		'sensor_mode': sensor_mode,
+		'exposure': exposure,
+		'iso': iso,
+		'exposure_speed': gains.get('exposure_speed'),
+		'analog_gain': gains.get('analog_gain'),
+		'digital_gain': gains.get('digital_gain'),
+		'mean': stats.get('mean'),
+		'p99': stats.get('p99'),
+		'clipped': stats.get('clipped'),
+		'source': source,
+	}
+
+def connect(path):
+	connection = sqlite3.connect(path)
+	connection.row_factory = sqlite3.Row
+	# Readers do not block the writer, and a commit does not wait for the disk twice
+	connection.execute("PRAGMA journal_mode=WAL")
+	connection.execute("PRAGMA synchronous=NORMAL")
+	return connection
+
+class Catalog(threading.Thread):
+	# Records are queued and inserted by a thread of their own, many to a transaction,
+	# so a capture never waits for the database
+	def __init__(self, path = '/share/pics/catalog.db', batch = 100, interval = 5.0):
+		threading.Thread.__init__(self, daemon=True)
+		self.path = path
+		self.batch = batch
+		self.interval = interval
+		self.queue = queue.Queue()
+		self.inserted = 0
+		os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+		with connect(path) as connection:
+			connection.executescript(schema)
+		connection.close()
+
+	def add(self, record):
+		self.queue.put(record)
+
+	def take(self):
+		# A batch, or whatever came within the interval. None once closed
+		records = []
+		deadline = time.monotonic() + self.interval
+		while len(records) < self.batch:
+			try:
+				record = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+			except queue.Empty:
+				break
+			if (record is None):
+				return records, True
+			records.append(record)
+		return records, False
+
+	def run(self):
+		connection = connect(self.path)
+		insert = "INSERT INTO captures ({}) VALUES ({})".format(
+			", ".join(columns), ", ".join(":" + column for column in columns))
+		done = False
+		while not done:
+			records, done = self.take()
+			if (len(records) == 0):
+				continue
+			try:
+				with connection:
+					connection.executemany(insert, records)
+				self.inserted += len(records)
+			except sqlite3.Error as e:
+				print("Catalog insert of {} records failed: {}".format(len(records), e))
+		connection.close()
+
+	def close(self):
+		self.queue.put(None)
+		self.join()
+		print("Catalog: {} records".format(self.inserted))
+
+def query(path, since = None, until = None, exposure = None, iso = None, source = None, like = None, limit = None):
+	# Every condition is optional, times are unix seconds
+	conditions = []
+	values = []
+	for column, operator, value in [('time', '>=', since), ('time', '<', until), ('exposure', '=', exposure),
+		('iso', '=', iso), ('source', '=', source), ('path', 'LIKE', like)]:
+		if (value is not None):
+			conditions.append("{} {} ?".format(column, operator))
+			values.append(value)
+	sql = "SELECT * FROM captures"
+	if (len(conditions) > 0):
+		sql += " WHERE " + " AND ".join(conditions)
+	sql += " ORDER BY time"
+	if (limit is not None):
+		sql += " LIMIT {:d}".format(limit)
+	connection = connect(path)
+	try:
+		return connection.execute(sql, values).fetchall()
+	finally:
+		connection.close()
+
+def parse_time(text):
+	# 7d, 12h or 30m ago, or a date and time
+	if (text is None):
+		return None
+	match = re.fullmatch(r'(\d+(?:\.\d+)?)([dhm])', text)
+	if (match is not None):
+		seconds = {'d': 86400, 'h': 3600, 'm': 60}[match.group(2)]
+		return time.time() - float(match.group(1)) * seconds
+	return datetime.datetime.fromisoformat(text).timestamp()
+
+def parse_args():
+	parser = argparse.ArgumentParser(description="MyCamera capture catalog")
+	parser.add_argument('--catalog', help='Catalog database', default='/share/pics/catalog.db')
+	parser.add_argument('--since', help='From this time on, as 7d, 12h, 30m or a date')
+	parser.add_argument('--until', help='Before this time, as --since')
+	parser.add_argument('--exposure', '-e', help='Exposure in ms', type=int)
+	parser.add_argument('--iso', '-i', help='ISO', type=int)
+	parser.add_argument('--source', help='Where the capture came from', choices=['mycamera', 'stack', 'autosave'])
+	parser.add_argument('--like', help='Path pattern, with % as the wildcard')
+	parser.add_argument('--limit', '-n', help='Number of records', type=int)
+	parser.add_argument('--count', help='Only count the records', action='store_true')
+	return parser.parse_args()
+
+def main():
+	args = parse_args()
+	t1 = time.monotonic()
+	rows = query(args.catalog, parse_time(args.since), parse_time(args.until), args.exposure, args.iso,
+		args.source, args.like, args.limit)
+	t2 = time.monotonic()
+	if (not args.count):
+		for row in rows:
+			stamp = datetime.datetime.fromtimestamp(row['time']).strftime("%Y-%m-%d %H:%M:%S")
+			print("{} {:>6} ms ISO {:<4} {}".format(stamp, row['exposure'], row['iso'], row['path']))
+	print("{} records in {:.1f} ms".format(len(rows), (t2 - t1) * 1000))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,99 @@
+import numpy as np
+
+# The 8 neighbours of a pixel
+offsets = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+# Batcher's sorting network for 8 values, a tenth of the time of np.median on whole frames
+network = [(0, 1), (2, 3), (4, 5), (6, 7), (0, 2), (1, 3), (4, 6), (5, 7), (1, 2), (5, 6),
+	(0, 4), (1, 5), (2, 6), (3, 7), (2, 4), (3, 5), (1, 2), (3, 4), (5, 6)]
+
+def colour_step(shape):
+	# In bayer data the nearest pixels of the same colour are two apart
+	return 2 if len(shape) == 2 else 1
+
+def scale(coords, source, target, step):
+	# Rows and columns from a frame of the source (height, width) to one of the target.
+	# Bayer data is scaled in blocks of one of each colour, every pixel keeps its colour site
+	source = np.array(source) // step
+	target = np.array(target) // step
+	return coords // step * target // source * step + coords % step
+
+def local_median(frame, step):
+	# Median of the neighbours of every pixel, from shifted views of a padded frame
+	height, width = frame.shape[:2]
+	pad = [(step, step), (step, step)] + [(0, 0)] * (frame.ndim - 2)
+	padded = np.pad(frame, pad, mode='reflect')
+	views = [padded[step + dy * step:step + dy * step + height, step + dx * step:step + dx * step + width]
+		for dy, dx in offsets]
+	for a, b in network:
+		views[a], views[b] = np.minimum(views[a], views[b]), np.maximum(views[a], views[b])
+	return (views[3].astype(np.float32) + views[4]) / 2
+
+def outliers(frame, kappa = 6.0, floor = 0.02):
+	# Pixels well above their neighbours, both in units of the noise and of white
+	white = float(np.iinfo(frame.dtype).max) if np.issubdtype(frame.dtype, np.integer) else 1.0
+	residual = frame - local_median(frame, colour_step(frame.shape))
+	# The noise from a sample of the frame is as good as from all of it
+	sigma = 1.4826 * float(np.median(np.abs(residual[::4, ::4])))
+	hot = residual > max(kappa * sigma, floor * white)
+	if (hot.ndim == 3):
+		hot = hot.any(axis=2)
+	return hot
+
+class HotPixelBuilder:
+	# Pixels that stand out in most frames are hot, noise and stars do not stay put
+	def __init__(self, kappa = 6.0, fraction = 0.8):
+		self.kappa = kappa
+		self.fraction = fraction
+		self.hits = None
+		self.shape = None
+		self.count = 0
+
+	def add(self, frame):
+		if (self.hits is None):
+			self.hits = np.zeros(frame.shape[:2], dtype=np.uint16)
+			self.shape = frame.shape
+		self.hits += outliers(frame, self.kappa)
+		self.count += 1
+
+	def result(self, resolution = None):
+		# Row and column of every hot pixel, scaled to the resolution the map is kept at
+		coords = np.argwhere(self.hits >= max(1, self.fraction * self.count)).astype(np.int32)
+		if (resolution is not None):
+			width, height = resolution
+			coords = scale(coords, self.shape[:2], (height, width), colour_step(self.shape))
+		print("Found {} hot pixels in {} frames".format(len(coords), self.count))
+		return coords
+
+class HotPixelCorrector:
+	# Replaces the hot pixels with the median of their neighbours, through index arrays
+	# worked out once per frame shape
+	def __init__(self, library):
+		self.library = library
+
+	def indices(self, key, shape):
+		def load():
+			coords = self.library.get('hot', key)
+			if (coords is None or len(coords) == 0):
+				return None
+			width, height = key[0]
+			step = colour_step(shape)
+			coords = np.unique(scale(coords, (height, width), shape[:2], step), axis=0)
+			rows = coords[:, 0]
+			cols = coords[:, 1]
+			dy = np.array([dy for dy, dx in offsets]) * step
+			dx = np.array([dx for dy, dx in offsets]) * step
+			# Pixels at the border take the ones of the same colour on the other side
+			near_rows = np.abs(rows[:, np.newaxis] + dy)
+			near_rows = np.where(near_rows >= shape[0], 2 * (shape[0] - 1) - near_rows, near_rows)
+			near_cols = np.abs(cols[:, np.newaxis] + dx)
+			near_cols = np.where(near_cols >= shape[1], 2 * (shape[1] - 1) - near_cols, near_cols)
+			return rows, cols, near_rows, near_cols
+		return self.library.cached(('hot', key, shape), load)
+
+	def apply(self, frame, key):
+		indices = self.indices(key, frame.shape)
+		if (indices is None):
+			return False
+		rows, cols, near_rows, near_cols = indices
+		frame[rows, cols] = np.median(frame[near_rows, near_cols], axis=1)
+		return True
@@ -0,0 +1,156 @@
+import collections
+import os
+import threading
+import time
+
+# Fallback for uptime() where /proc cannot tell when the process started
+imported = time.monotonic()
+
+def uptime():
+	# Seconds since the process started, interpreter start up and imports included
+	try:
+		with open('/proc/self/stat') as f:
+			# The fields after the command name, which may contain spaces
+			fields = f.read().rsplit(')', 1)[1].split()
+		with open('/proc/uptime') as f:
+			now = float(f.read().split()[0])
+		return now - int(fields[19]) / os.sysconf('SC_CLK_TCK')
+	except (OSError, ValueError, IndexError):
+		return time.monotonic() - imported
+
+class Counter:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.value = 0
+
+	def inc(self, value = 1):
+		with self.lock:
+			self.value += value
+
+	def snapshot(self):
+		return {'count': self.value}
+
+class Histogram:
+	# Percentiles come from the latest samples, count and mean from all of them
+	def __init__(self, size = 1000):
+		self.lock = threading.Lock()
+		self.samples = collections.deque(maxlen=size)
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+	def add(self, value):
+		with self.lock:
+			self.samples.append(value)
+			self.count += 1
+			self.total += value
+			self.max = max(self.max, value)
+
+	def percentile(self, samples, p):
+		if (len(samples) == 0):
+			return 0.0
+		return samples[min(int(len(samples) * p / 100), len(samples) - 1)]
+
+	def snapshot(self):
+		with self.lock:
+			samples = sorted(self.samples)
+			count = self.count
+			total = self.total
+			peak = self.max
+		return {
+			'count': count,
+			'mean': total / count if count > 0 else 0.0,
+			'p50': self.percentile(samples, 50),
+			'p99': self.percentile(samples, 99),
+			'max': peak,
+		}
+
+class Metrics:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.counters = {}
+		self.histograms = {}
+		self.queues = {}
+
+	def counter(self, name):
+		with self.lock:
+			if (name not in self.counters):
+				self.counters[name] = Counter()
+			return self.counters[name]
+
+	def histogram(self, name):
+		with self.lock:
+			if (name not in self.histograms):
+				self.histograms[name] = Histogram()
+			return self.histograms[name]
+
+	def watch_queue(self, name, q):
+		with self.lock:
+			self.queues[name] = q
+
+	def sample(self):
+		with self.lock:
+			queues = list(self.queues.items())
+		for name, q in queues:
+			self.histogram("queue.{}".format(name)).add(q.qsize())
+
+	def snapshot(self):
+		with self.lock:
+			counters = list(self.counters.items())
+			histograms = list(self.histograms.items())
+		snapshot = {}
+		for name, counter in counters:
+			snapshot[name] = counter.snapshot()
+		for name, histogram in histograms:
+			snapshot[name] = histogram.snapshot()
+		return snapshot
+
+	def format(self):
+		lines = ["{:<20} {:>7} {:>7} {:>7}".format("", "mean", "p50", "p99")]
+		for name, values in sorted(self.snapshot().items()):
+			if ('p50' in values):
+				lines.append("{:<20} {:>7.1f} {:>7.1f} {:>7.1f}".format(name, values['mean'], values['p50'], values['p99']))
+			else:
+				lines.append("{:<20} {:>7}".format(name, values['count']))
+		return "\n".join(lines)
+
+class CsvExporter:
+	def __init__(self, metrics, filename):
+		self.metrics = metrics
+		self.file = open(filename, 'w')
+		self.file.write("time,name,count,mean,p50,p99,max\n")
+
+	def export(self):
+		now = time.time()
+		for name, values in sorted(self.metrics.snapshot().items()):
+			self.file.write("{:.3f},{},{},{:.3f},{:.3f},{:.3f},{:.3f}\n".format(now, name,
+				values['count'], values.get('mean', 0.0), values.get('p50', 0.0),
+				values.get('p99', 0.0), values.get('max', 0.0)))
+		self.file.flush()
+
+	def close(self):
+		self.file.close()
+
+class Sampler(threading.Thread):
+	def __init__(self, metrics, interval = 0.1, exporter = None, export_interval = 5.0):
+		threading.Thread.__init__(self, daemon=True)
+		self.metrics = metrics
+		self.interval = interval
+		self.exporter = exporter
+		self.export_interval = export_interval
+		self.stopped = threading.Event()
+
+	def stop(self):
+		self.stopped.set()
+		self.join()
+		if (self.exporter is not None):
+			self.exporter.export()
+			self.exporter.close()
+
+	def run(self):
+		next_export = time.monotonic() + self.export_interval
+		while not self.stopped.wait(self.interval):
+			self.metrics.sample()
+			if (self.exporter is not None and time.monotonic() >= next_export):
+				self.exporter.export()
+				next_export += self.export_interval
@@ -0,0 +1,111 @@
+import datetime
+import numpy as np
+
+class MotionEvent:
+	def __init__(self, active, tiles):
+		self.active = active
+		self.tiles = tiles
+		self.time = datetime.datetime.now()
+
+	def __str__(self):
+		state = "start" if self.active else "end"
+		return "Motion {} at {} ({} tiles)".format(state, self.time.strftime("%H:%M:%S"), self.tiles)
+
+def tile_means(frame, tile):
+	# One value per tile x tile block, the ragged right and bottom edges are left out
+	height = frame.shape[0] // tile * tile
+	width = frame.shape[1] // tile * tile
+	blocks = frame[:height, :width].reshape(height // tile, tile, width // tile, tile)
+	return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+def load_mask(filename):
+	# White is watched, black is ignored
+	from PIL import Image
+	return np.asarray(Image.open(filename).convert('L')) > 127
+
+class MotionDetector:
+	# Works on the diff frames, which are |luma difference| centred on 127
+	def __init__(self, tile = 16, kappa = 4.0, floor = 4.0, release = 0.5, min_tiles = 2,
+		on_frames = 2, off_frames = 10, alpha = 0.05, warmup = 10):
+		self.tile = tile
+		self.kappa = kappa
+		self.floor = floor
+		self.release = release
+		self.min_tiles = min_tiles
+		self.on_frames = on_frames
+		self.off_frames = off_frames
+		self.alpha = alpha
+		self.warmup = warmup
+		self.mask = None
+		self.reset()
+
+	def reset(self):
+		self.mean = None
+		self.var = None
+		self.active = None
+		self.watched = None
+		self.count = 0
+		self.hits = 0
+		self.misses = 0
+		self.motion = False
+
+	def set_mask(self, mask):
+		self.mask = mask
+		self.watched = None
+
+	def fit_mask(self, shape):
+		# The mask can be drawn at any resolution, every tile takes the value at its centre
+		if (self.mask is None):
+			return None
+		rows = (np.arange(shape[0]) * 2 + 1) * self.mask.shape[0] // (shape[0] * 2)
+		cols = (np.arange(shape[1]) * 2 + 1) * self.mask.shape[1] // (shape[1] * 2)
+		return self.mask[np.ix_(rows, cols)]
+
+	def start(self, energy):
+		self.mean = energy.copy()
+		self.var = np.zeros(energy.shape, dtype=np.float32)
+		self.active = np.zeros(energy.shape, dtype=bool)
+		self.count = 0
+
+	def update(self, diff):
+		energy = tile_means(diff, self.tile)
+		energy -= 127
+		if (self.mean is None or self.mean.shape != energy.shape):
+			self.start(energy)
+		if (self.watched is None or self.watched.shape != energy.shape):
+			self.watched = self.fit_mask(energy.shape)
+		self.count += 1
+
+		# Every tile gets its own threshold from its own noise
+		margin = np.maximum(self.kappa * np.sqrt(self.var), self.floor)
+		high = self.mean + margin
+		low = self.mean + self.release * margin
+		# A tile turns active above the high threshold and only turns quiet again below the low one
+		self.active = np.where(self.active, energy > low, energy > high)
+		if (self.watched is not None):
+			self.active &= self.watched
+		if (self.count <= self.warmup):
+			self.active[...] = False
+
+		# The noise only learns from quiet tiles, or anything that lingers becomes background
+		quiet = ~self.active
+		delta = energy - self.mean
+		self.mean += np.where(quiet, self.alpha * delta, 0)
+		self.var += np.where(quiet, self.alpha * (delta * delta - self.var), 0)
+
+		tiles = int(np.count_nonzero(self.active))
+		if (tiles >= self.min_tiles):
+			self.hits += 1
+			self.misses = 0
+		else:
+			self.misses += 1
+			self.hits = 0
+
+		# The same hysteresis over time, a blip does not start it and a pause does not end it
+		if (not self.motion and self.hits >= self.on_frames):
+			self.motion = True
+			return MotionEvent(True, tiles)
+		if (self.motion and self.misses >= self.off_frames):
+			self.motion = False
+			return MotionEvent(False, tiles)
+		return None
@@ -0,0 +1,900 @@
+import datetime
+import enum
+import functools
+import queue
+import threading
+import time
+import numpy as np
+from mycamera import Config, FrameBuffers, GainCache
+from mybayer import luma
+from mymetrics import Metrics, Sampler, CsvExporter, uptime
+from myprocess import SharedArrays, LocalExecutor, ProcessExecutor
+from mywriter import FrameWriter, extensions
+from mycalib import CalibrationLibrary, Calibrator
+from myhotpixel import HotPixelBuilder, HotPixelCorrector
+from mymotion import MotionDetector
+from myschedule import Schedule
+from mystats import FrameStats, ExposureController
+from mycatalog import record
+
+def strip_rows(shape):
+	# Rows of a strip whose scratch stays in the cache between the passes over it
+	return max(1, (1 << 17) // int(np.prod(shape[1:])))
+
+def average_frame(frame, avg, out, tmp, alpha):
+	# out = avg + alpha * (frame - avg) on 8.8 fixed point, avg and out hold 256 times
+	# the value. Nothing overflows 16 bits for alpha up to 1, and the integer part
+	# ends up exactly on a still frame
+	a = int(round(alpha * 256))
+	rows = len(tmp)
+	for y in range(0, len(frame), rows):
+		old = avg[y:y + rows]
+		new = out[y:y + rows]
+		scratch = tmp[:len(old)]
+		np.right_shift(old, 8, out=new)
+		new *= a
+		np.subtract(old, new, out=new)
+		np.multiply(frame[y:y + rows], a, out=scratch, dtype=np.uint16)
+		new += scratch
+
+def average_image(avg, out):
+	# The 8 bit frame of a fixed point average
+	np.right_shift(avg, 8, out=out, casting='unsafe')
+
+def diff_frame(frame, avg, gray, tmp, out, gain):
+	# The luma of the difference is the difference of the lumas, each a matrix product
+	weights = luma * gain
+	rows = len(tmp)
+	for y in range(0, len(frame), rows):
+		strip = gray[y:y + rows]
+		scratch = tmp[:len(strip)]
+		np.matmul(frame[y:y + rows], weights, out=strip)
+		np.matmul(avg[y:y + rows], weights / 256, out=scratch)
+		strip -= scratch
+	mean = float(gray.mean())
+	gray -= mean
+	np.absolute(gray, out=gray)
+	gray += 127
+	np.clip(gray, 0, 255, out=gray)
+	np.copyto(out, gray, casting='unsafe')
+	return mean
+
+class LiveUpdate(enum.Enum):
+	PAUSE = 0
+	RUN   = 1
+	ONCE  = 2
+	EXIT  = 3
+
+class Display(enum.Enum):
+	NOW  = 0
+	AVG  = 1
+	DIFF = 2
+
+class Overflow(enum.Enum):
+	BLOCK  = 0
+	OLDEST = 1
+	NEWEST = 2
+
+class FrameQueue(queue.Queue):
+	def __init__(self, maxsize = 1, policy = Overflow.BLOCK):
+		queue.Queue.__init__(self, maxsize)
+		self.policy = policy
+		self.dropped = Metrics().counter("dropped")
+
+	def set_policy(self, policy):
+		print("Set overflow: {}".format(policy))
+		self.policy = policy
+
+	def set_metrics(self, metrics, name):
+		self.dropped = metrics.counter("{}.dropped".format(name))
+
+	def drop(self, item):
+		self.queue.remove(item)
+		self.unfinished_tasks -= 1
+		self.dropped.inc()
+
+	def put(self, item, block = True, timeout = None):
+		if (self.policy is Overflow.BLOCK or item is None):
+			return queue.Queue.put(self, item, block, timeout)
+
+		with self.not_full:
+			while True:
+				# The exit marker and frames that have to be saved are never dropped
+				victims = [i for i in self.queue if i is not None and not i.keep]
+				if (self.policy is Overflow.NEWEST):
+					for victim in victims:
+						self.drop(victim)
+				elif (self._qsize() >= self.maxsize and len(victims) > 0):
+					self.drop(victims[0])
+				if (self._qsize() < self.maxsize):
+					break
+				self.not_full.wait()
+			self._put(item)
+			self.unfinished_tasks += 1
+			self.not_empty.notify()
+
+class LiveUpdater:
+	class WorkItem:
+		def __init__(self):
+			self.config = None
+			self.array = None
+			self.image = None
+			self.preview = None
+			self.avg = None
+			self.diff = None
+			self.timestamp = None
+			self.save = False
+			self.keep = False
+			self.key = None
+			self.motion = False
+			self.event = None
+			self.gains = None
+			self.stats = None
+			self.created = time.monotonic()
+
+		def age(self):
+			return (time.monotonic() - self.created) * 1000
+
+		def get_image(self):
+			if (self.image is None and self.array is not None):
+				# PIL is only loaded once a frame is made into an image
+				from PIL import Image
+				self.image = Image.fromarray(self.array)
+			return self.image
+
+	class Worker(threading.Thread):
+		def __init__(self, in_q = None, out_q = None):
+			threading.Thread.__init__(self)
+			self.in_q = in_q
+			self.out_q = out_q
+			self.set_metrics(Metrics(), type(self).__name__)
+			self.executor = LocalExecutor()
+			self.allocator = None
+
+		def set_executor(self, executor, allocator):
+			self.executor = executor
+			self.allocator = allocator
+
+		def empty(self, shape, dtype):
+			# State the kernels update in place has to be shared with the pool
+			if (self.allocator is not None):
+				return self.allocator.empty(shape, dtype)
+			return np.empty(shape, dtype)
+
+		def set_metrics(self, metrics, name):
+			self.metrics = metrics
+			self.stage = name
+			self.timing = metrics.histogram("{}.ms".format(name))
+
+		def get(self):
+			if (self.in_q is not None):
+				return self.in_q.get()
+			return None
+
+		def work(self, item):
+			return item
+
+		def run(self):
+			while True:
+				item = self.get()
+
+				if (item is not None):
+					t1 = time.monotonic()
+					item = self.work(item)
+					t2 = time.monotonic()
+					self.timing.add((t2 - t1) * 1000)
+
+				if (self.in_q is not None):
+					self.in_q.task_done()
+
+				if (self.out_q is not None):
+					self.out_q.put(item)
+
+				if (item is None):
+					print("Exit Worker")
+					break
+
+	class CaptureWorker(Worker):
+		def __init__(self, mycam, out_q, raw = True, stream = True):
+			LiveUpdater.Worker.__init__(self, None, out_q)
+			self.mycam = mycam
+			self.raw = raw
+			self.stream = raw and stream
+			self.num = 0
+			self.cv = threading.Condition()
+			self.config = None
+			self.config_time = 0
+			self.debounce = 0.25
+			self.state = LiveUpdate.PAUSE
+			self.full = False
+			self.save = False
+			self.keep = True
+			self.gains = GainCache()
+			self.settling = False
+			self.settler = None
+			self.cached = None
+			self.policy = 'skip'
+			self.schedule = None
+			self.full_frames = 0
+			self.all_gains = False
+
+		def set_delay(self, delay):
+			print("Set delay: {}".format(delay))
+			with self.cv:
+				self.schedule = None
+				if (delay > 0):
+					self.schedule = Schedule(delay, self.policy, self.metrics)
+				self.cv.notify()
+
+		def set_keep(self, keep):
+			print("Set keep: {}".format(keep))
+			with self.cv:
+				self.keep = keep
+
+		def set_full(self, full):
+			print("Set full resolution: {}".format(full))
+			with self.cv:
+				self.full = full
+
+		def set_all_gains(self, state):
+			# Gains read for every frame, not only for the ones that may be saved
+			print("Set all gains: {}".format(state))
+			self.all_gains = state
+
+		def capture_full(self, frames):
+			# The next frames are read out at full resolution too, and never dropped
+			print("Set full frames: {}".format(frames))
+			with self.cv:
+				self.full_frames = frames
+
+		def save_once(self):
+			with self.cv:
+				self.save = True
+				if (self.state is LiveUpdate.PAUSE):
+					self.set_state(LiveUpdate.ONCE)
+
+		def set_config(self, config):
+			print("Set config: {}".format(vars(config)))
+			with self.cv:
+				# Changes pile up until the capture thread gets to them
+				if (self.config is None):
+					self.config = Config()
+				self.config.merge(config)
+				self.config_time = time.monotonic()
+				self.cv.notify()
+
+		def take_config(self, stream):
+			# While streaming, a slider being dragged is left alone until it stops
+			if (self.config is None):
+				return None
+			if (stream and time.monotonic() - self.config_time < self.debounce):
+				return None
+			config = self.config
+			self.config = None
+			return config
+
+		def set_state(self, state):
+			print("Set state: {}".format(state))
+			with self.cv:
+				if (state is LiveUpdate.RUN and self.schedule is not None):
+					self.schedule.reset()
+				self.state = state
+				self.cv.notify()
+
+		def start_settle(self):
+			print("Settle gains")
+			with self.cv:
+				self.settling = True
+				self.cv.notify()
+
+		def settle(self):
+			# Polled between frames, or while paused, so the camera stays on this thread.
+			# Returns how long the caller may wait before the next poll
+			if (self.settling):
+				self.settling = False
+				# Pressed again right after the gains came from the cache, they are measured anew
+				self.mycam.unlock_gains()
+				key = self.mycam.key()
+				self.settler = self.mycam.start_settle(self.gains, refresh=(key == self.cached))
+				self.cached = None
+				if (self.settler is None):
+					print("Calibrate again to measure them anew")
+					self.cached = key
+			if (self.settler is None):
+				return None
+			interval = self.settler.poll()
+			if (interval is None):
+				if (self.mycam.end_settle(self.settler, self.gains)):
+					self.metrics.histogram("{}.settle_ms".format(self.stage)).add(self.settler.elapsed() * 1000)
+				self.settler = None
+			return interval
+
+		def wait(self):
+			# Returns once there is something to capture. While live with a delay the next
+			# shot is due at its slot however long the last one took, saving overlaps the wait
+			while True:
+				while self.state is LiveUpdate.PAUSE:
+					self.cv.wait(self.settle())
+				if (self.state is not LiveUpdate.RUN or self.schedule is None):
+					return False
+				self.schedule.skip()
+				time_wait = self.schedule.due()
+				if (time_wait <= 0):
+					return True
+				interval = self.settle()
+				self.cv.wait(time_wait if interval is None else min(time_wait, interval))
+
+		def get(self):
+			with self.cv:
+				if (self.state is not LiveUpdate.RUN or self.schedule is not None):
+					# The video port is only kept open while running live, long delays gain nothing from it
+					self.mycam.stop_stream()
+				scheduled = self.wait()
+				if (self.state is LiveUpdate.EXIT):
+					self.mycam.stop_stream()
+					return None
+				if (scheduled):
+					self.schedule.fire()
+				stream = self.stream and self.state is LiveUpdate.RUN and self.schedule is None
+				if (self.state is LiveUpdate.ONCE):
+					self.set_state(LiveUpdate.PAUSE)
+
+				item = LiveUpdater.WorkItem()
+				item.stream = stream
+				item.save = self.save
+				wanted = self.full_frames > 0
+				self.full_frames = max(0, self.full_frames - 1)
+				item.full = self.full or self.save or wanted
+				item.keep = self.save or wanted or (self.full and self.keep)
+				self.save = False
+				item.config = self.take_config(stream)
+
+#			if (self.config is not None):
+#				item.config = self.config
+#				self.config = None
+#			else:
+#				item.config = None
+
+			return item
+
+		def work(self, item):
+			if (item.config is not None and self.mycam.set_config(item.config)):
+				self.metrics.counter("{}.reconfigured".format(self.stage)).inc()
+			with self.cv:
+				self.settle()
+
+#			print("Capture A")
+			try:
+#				self.mycam.capture("temp.jpg")
+				# The full frame is only read out when it is going to be saved
+				if (item.stream):
+					item.preview = self.mycam.capture_stream(resize=True)
+					if (item.full):
+						item.array = self.mycam.capture_array(use_video_port=True)
+				elif (self.raw and item.full):
+					item.array = self.mycam.capture_array()
+				elif (self.raw):
+					item.preview = self.mycam.capture_array(resize=True)
+				else:
+					item.image = self.mycam.capture_image()
+				item.key = self.mycam.key()
+				if (item.full or self.all_gains):
+					# Only for frames that may be saved or metered, reading them is not free
+					item.gains = self.mycam.gains()
+			except:
+#				print("Capture X:", sys.exc_info()[0])
+				item.array = None
+				item.image = None
+				item.preview = None
+				self.mycam.stop_stream()
+				self.metrics.counter("{}.failed".format(self.stage)).inc()
+#			print("Capture B")
+			return item
+
+	class CalibrateWorker(Worker):
+		def __init__(self, library, in_q, out_q):
+			LiveUpdater.Worker.__init__(self, in_q, out_q)
+			self.library = library
+			self.calibrator = Calibrator(library)
+			self.corrector = HotPixelCorrector(library)
+			self.state = False
+			self.hotpixels = False
+			self.builder = None
+			self.learn = 0
+
+		def set_state(self, state):
+			print("Set calibrate: {}".format(state))
+			self.state = state
+
+		def set_hotpixels(self, state):
+			print("Set hot pixels: {}".format(state))
+			self.hotpixels = state
+
+		def learn_hotpixels(self, frames):
+			print("Set learn hot pixels: {}".format(frames))
+			self.builder = HotPixelBuilder()
+			self.learn = frames
+
+		def build(self, item):
+			# Learns from full frames only, the camera's resizer averages single hot pixels
+			# away. The map is kept at the resolution of the key
+			self.builder.add(item.array)
+			if (self.builder.count >= self.learn):
+				self.library.save('hot', item.key, self.builder.result(item.key[0]), self.builder.count)
+				self.builder = None
+
+		def work(self, item):
+			if (self.builder is not None and item.key is not None and item.array is not None):
+				self.build(item)
+			# Frames in the capture ring are calibrated in place
+			if (self.state is True and item.key is not None):
+				for frame in [item.preview, item.array]:
+					if (frame is not None and not self.calibrator.apply(frame, item.key)):
+						self.metrics.counter("{}.missing".format(self.stage)).inc()
+			# After the dark, which takes most of them away already. Full frames only,
+			# in the preview the camera's resizer has averaged them away
+			if (self.hotpixels is True and item.key is not None and item.array is not None):
+				self.corrector.apply(item.array, item.key)
+			return item
+
+	class ScaleWorker(Worker):
+		def __init__(self, in_q, out_q):
+			LiveUpdater.Worker.__init__(self, in_q, out_q)
+
+		def work(self, item):
+			# Only full resolution stills without a hardware resized preview end up here
+			if (item.preview is None and item.get_image() is not None):
+				size = (960, 540)
+				thumbnail = item.image.copy()
+				thumbnail.thumbnail(size)
+				item.preview = np.asarray(thumbnail)
+			return item
+
+	class StatsWorker(Worker):
+		def __init__(self, capture, in_q, out_q):
+			LiveUpdater.Worker.__init__(self, in_q, out_q)
+			self.capture = capture
+			self.stats = FrameStats()
+			self.controller = ExposureController()
+			self.auto = False
+			self.wanted = None
+			self.waiting = 0
+
+		def set_auto(self, state):
+			print("Set auto exposure: {}".format(state))
+			self.auto = state
+			self.wanted = None
+
+		def settings(self, item):
+			# What the frame was taken with, the camera's own choice while it runs auto.
+			# The gains were read by the capture stage, only it touches the camera
+			resolution, sensor_mode, exposure, iso = item.key
+			if (exposure == 0):
+				if (item.gains is None):
+					return None
+				exposure = max(1, item.gains['exposure_speed'] // 1000)
+				iso = iso or int(round(item.gains['analog_gain'] * 100))
+			return exposure, iso
+
+		def applied(self, exposure, iso):
+			# Frames still in the pipeline were taken before the last change,
+			# a camera that cannot do what was asked is given up on after a while
+			self.waiting += 1
+			wanted_exposure, wanted_iso = self.wanted
+			return ((iso == wanted_iso and abs(exposure - wanted_exposure) <= max(1, wanted_exposure // 50)) or
+				self.waiting > 10)
+
+		def control(self, item):
+			taken = self.settings(item)
+			if (taken is None):
+				return
+			exposure, iso = taken
+			if (self.wanted is None or self.applied(exposure, iso)):
+				settings = self.controller.update(self.stats, exposure, iso)
+				if (settings is not None):
+					self.wanted = settings
+					self.waiting = 0
+					self.capture.set_config(Config(exposure = settings[0], iso = settings[1]))
+
+		def work(self, item):
+			if (item.preview is None):
+				return item
+			self.stats.update(item.preview)
+			item.stats = self.stats.summary()
+			low, high = self.stats.clipped()
+			self.metrics.histogram("stats.level").add(self.stats.level(self.controller.gamma) * 100)
+			self.metrics.histogram("stats.clipped").add(high * 100)
+			if (self.auto is True and item.key is not None):
+				self.control(item)
+			return item
+
+	class AverageWorker(Worker):
+		def __init__(self, in_q, out_q = None, alpha = 0.3, buffers = 6):
+			LiveUpdater.Worker.__init__(self, in_q, out_q)
+			self.alpha = alpha
+			self.tmp = None
+			self.out = FrameBuffers(buffers)
+			self.last = None
+
+		def set_executor(self, executor, allocator):
+			LiveUpdater.Worker.set_executor(self, executor, allocator)
+			self.out.set_allocator(allocator)
+			self.last = None
+
+		def set_alpha(self, alpha):
+			print("Set average: {}".format(alpha))
+			self.alpha = alpha
+
+		def calc_average(self, item):
+			frame = item.preview
+			if (self.last is None or self.last.shape != frame.shape):
+				print("No previous average")
+				self.tmp = self.empty((strip_rows(frame.shape),) + frame.shape[1:], np.uint16)
+				self.last = self.out.next(frame.shape, np.uint16)
+				np.left_shift(frame, 8, out=self.last, dtype=np.uint16)
+			# The newest average is the state, stages further down still read the previous ones
+			avg = self.last
+			self.last = self.out.next(frame.shape, np.uint16)
+			self.executor.call(average_frame, frame, avg, self.last, self.tmp, self.alpha)
+
+		def work(self, item):
+			if (item.preview is not None):
+				self.calc_average(item)
+			item.avg = self.last
+
+			return item
+
+	class DiffWorker(Worker):
+		def __init__(self, in_q, out_q = None, gain = 10, buffers = 6):
+			LiveUpdater.Worker.__init__(self, in_q, out_q)
+			self.gain = gain
+			self.gray = None
+			self.tmp = None
+			self.out = FrameBuffers(buffers)
+			self.detector = MotionDetector()
+
+		def set_executor(self, executor, allocator):
+			LiveUpdater.Worker.set_executor(self, executor, allocator)
+			self.out.set_allocator(allocator)
+			self.gray = None
+
+		def set_gain(self, gain):
+			print("Set gain: {}".format(gain))
+			self.gain = gain
+
+		def calc_diff(self, item):
+			frame = item.preview
+			if (self.gray is None or self.gray.shape != frame.shape[:2]):
+				self.gray = self.empty(frame.shape[:2], np.float32)
+				self.tmp = self.empty((strip_rows(frame.shape), frame.shape[1]), np.float32)
+			item.diff = self.out.next(frame.shape[:2])
+			mean = self.executor.call(diff_frame, frame, item.avg, self.gray, self.tmp, item.diff, self.gain)
+			print("Mean: {}".format(mean))
+
+		def set_mask(self, mask):
+			self.detector.set_mask(mask)
+
+		def detect(self, item):
+			item.event = self.detector.update(item.diff)
+			item.motion = self.detector.motion
+			if (item.event is not None):
+				print(item.event)
+				self.metrics.counter("motion.events").inc()
+
+		def work(self, item):
+			item.diff = None
+			if (item.preview is not None) and (item.avg is not None):
+				self.calc_diff(item)
+				self.detect(item)
+
+			return item
+
+	class DisplayWorker(Worker):
+		def __init__(self, mycanvas, in_q, out_q = None, buffers = 6):
+			LiveUpdater.Worker.__init__(self, in_q, out_q)
+			self.mycanvas = mycanvas
+			self.server = None
+			self.display = Display.NOW
+			self.first = True
+			self.out = FrameBuffers(buffers)
+			self.shown = None
+			self.image = None
+
+		def get_timestamp(self):
+			now = datetime.datetime.now()
+			timestamp = now.strftime("%Y%m%d_%H%M%S")
+			return timestamp
+
+		def set_display(self, display):
+			self.display = display
+
+		def set_server(self, server):
+			self.server = server
+
+		def average(self, item):
+			# The fixed point average only becomes an 8 bit frame when it is shown
+			if (item.avg is None):
+				return None
+			if (self.shown is not item):
+				self.shown = item
+				self.image = self.out.next(item.avg.shape)
+				average_image(item.avg, self.image)
+			return self.image
+
+		def frame(self, display, item):
+			if (display is Display.NOW):
+				return item.preview
+			if (display is Display.AVG):
+				return self.average(item)
+			return item.diff
+
+		def publish(self, item):
+			# Every mode has its own stream, encoded only while someone watches it
+			for display in Display:
+				if (self.server.watched(display.name.lower())):
+					self.server.publish(display.name.lower(), self.frame(display, item))
+
+		def work(self, item):
+			if (self.server is not None):
+				self.publish(item)
+
+			array = self.frame(self.display, item)
+			if (array is not None):
+				item.timestamp = self.get_timestamp()
+				full = None
+				if (self.display is Display.NOW):
+					# Lets the loupe zoom into the real pixels
+					full = item.array
+				# Painted by the Tk main loop, never from this thread
+				if (self.mycanvas is not None):
+					self.mycanvas.post_frame(array, item.timestamp, full)
+				if (self.first):
+					self.first = False
+					print("First frame after {:.2f}s".format(uptime()))
+					self.metrics.histogram("startup.first_frame_ms").add(uptime() * 1000)
+				self.metrics.histogram("latency.display").add(item.age())
+			else:
+				self.metrics.counter("{}.missing".format(self.stage)).inc()
+
+			return item
+
+	class AutosaveWorker(Worker):
+		def __init__(self, mycanvas, writer, in_q, out_q = None):
+			LiveUpdater.Worker.__init__(self, in_q, out_q)
+			self.mycanvas = mycanvas
+			self.writer = writer
+			self.state = False
+			self.motion = False
+			self.ring = None
+			self.trigger = False
+			self.catalog = None
+			self.saved = 0
+
+		def set_state(self, state):
+			print("Set autosave: {}".format(state))
+			self.state = state
+
+		def set_ring(self, ring, trigger):
+			print("Set ring: {} frames, trigger on motion: {}".format(ring.count, trigger))
+			self.ring = ring
+			self.trigger = trigger
+
+		def set_motion(self, motion):
+			print("Set autosave on motion: {}".format(motion))
+			self.motion = motion
+
+		def wanted(self, item):
+			if (item.save is True):
+				return True
+			if (self.state is True and self.motion is True and not item.motion):
+				self.metrics.counter("{}.still".format(self.stage)).inc()
+				return False
+			return self.state is True
+
+		def set_catalog(self, catalog):
+			self.catalog = catalog
+
+		def basename(self):
+			# Many frames are saved within a second, each gets a name of its own
+			self.saved += 1
+			stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:-3]
+			return "{}_{:06d}".format(stamp, self.saved)
+
+		def remember(self, item):
+			# Every preview goes into the ring, whether it is saved or not
+			if (item.preview is not None):
+				self.ring.write(item.preview, item.motion)
+			if (self.trigger is True and item.event is not None and item.event.active):
+				self.ring.trigger()
+
+		def work(self, item):
+			if (self.ring is not None):
+				self.remember(item)
+			if (self.wanted(item) and
+				(item.array is not None or item.image is not None)):
+				print("Saving...")
+				# Encoded and written behind the pipeline's back, catalogued once it is in place
+				basename = self.basename()
+				format = self.writer.format
+				done = None
+				if (self.catalog is not None and item.key is not None):
+					path = basename + extensions[format]
+					done = functools.partial(self.catalog.add, record(path, item.key, item.gains, item.stats, 'autosave'))
+				if (item.array is not None):
+					item.filename = self.writer.write(item.array, basename, format, done=done)
+				else:
+					item.filename = self.writer.write(item.image, basename, format, done=done)
+				self.metrics.histogram("latency.save").add(item.age())
+			return item
+
+	def __init__(self, mycam, mycanvas, alpha = 0.3, gain = 10, policy = Overflow.NEWEST, processes = 0, library = None):
+		# Preview stages always get the freshest frame, frames to be saved are kept
+		self.gq = FrameQueue(1, policy)
+		self.aq = FrameQueue(1, policy)
+		self.hq = FrameQueue(1, policy)
+		self.bq = FrameQueue(1, policy)
+		self.cq = FrameQueue(1, policy)
+		self.dq = FrameQueue(1, policy)
+		self.eq = FrameQueue(1, policy)
+		self.queues = {"calibrate": self.gq, "scale": self.aq, "stats": self.hq, "average": self.bq, "diff": self.cq,
+			"display": self.dq, "autosave": self.eq}
+
+		if (library is None):
+			library = CalibrationLibrary()
+		self.aw = self.CaptureWorker(mycam, self.gq)
+		self.gw = self.CalibrateWorker(library, self.gq, self.aq)
+		self.bw = self.ScaleWorker(self.aq, self.hq)
+		self.hw = self.StatsWorker(self.aw, self.hq, self.bq)
+		self.cw = self.AverageWorker(self.bq, self.cq, alpha)
+		self.dw = self.DiffWorker(self.cq, self.dq, gain)
+		self.ew = self.DisplayWorker(mycanvas, self.dq, self.eq)
+		self.metrics = Metrics()
+		self.writer = FrameWriter(processes = processes, metrics = self.metrics)
+		self.fw = self.AutosaveWorker(mycanvas, self.writer, self.eq)
+
+		# Every stage and queue can hold a captured frame, plus the one being captured
+		mycam.set_buffers(8 + 7 + 1)
+
+		for name, worker in [("capture", self.aw), ("calibrate", self.gw), ("scale", self.bw), ("stats", self.hw),
+			("average", self.cw), ("diff", self.dw), ("display", self.ew), ("autosave", self.fw)]:
+			worker.set_metrics(self.metrics, name)
+		for name, q in self.queues.items():
+			self.metrics.watch_queue(name, q)
+			q.set_metrics(self.metrics, name)
+		self.sampler = None
+		self.exporter = None
+
+		self.arrays = None
+		self.executor = None
+		if (processes > 0):
+			# Frames are captured into shared memory and handed to the pool by reference
+			self.arrays = SharedArrays()
+			self.executor = ProcessExecutor(self.arrays, processes)
+			mycam.set_allocator(self.arrays)
+			for worker in [self.cw, self.dw]:
+				worker.set_executor(self.executor, self.arrays)
+
+	def export_csv(self, filename):
+		self.exporter = CsvExporter(self.metrics, filename)
+
+	def start(self):
+		self.sampler = Sampler(self.metrics, exporter=self.exporter)
+		self.sampler.start()
+		self.writer.start()
+		self.aw.start()
+		self.gw.start()
+		self.bw.start()
+		self.hw.start()
+		self.cw.start()
+		self.dw.start()
+		self.ew.start()
+		self.fw.start()
+
+	def join(self):
+		self.aw.set_state(LiveUpdate.EXIT)
+
+		self.gq.join()
+		self.aq.join()
+		self.hq.join()
+		self.bq.join()
+		self.cq.join()
+		self.dq.join()
+		self.eq.join()
+
+		self.aw.join()
+		self.gw.join()
+		self.bw.join()
+		self.hw.join()
+		self.cw.join()
+		self.dw.join()
+		self.ew.join()
+		self.fw.join()
+		if (self.fw.ring is not None):
+			self.fw.ring.close()
+		self.writer.close()
+		self.sampler.stop()
+
+		if (self.executor is not None):
+			self.executor.shutdown()
+			self.arrays.close()
+
+	def set_display(self, display):
+		self.ew.set_display(display)
+
+	def set_server(self, server):
+		self.ew.set_server(server)
+
+	def set_config(self, config):
+		self.aw.set_config(config)
+
+	def set_delay(self, delay):
+		# Seconds from one live frame to the next, 0 for as fast as they come
+		self.aw.set_delay(delay)
+
+	def set_alpha(self, alpha):
+		self.cw.set_alpha(alpha)
+
+	def auto_exposure(self, status):
+		self.aw.set_all_gains(status)
+		self.hw.set_auto(status)
+
+	def settle(self):
+		self.aw.start_settle()
+
+	def calibrate(self, status):
+		self.gw.set_state(status)
+
+	def hotpixels(self, status):
+		self.gw.set_hotpixels(status)
+
+	def learn_hotpixels(self, frames = 20):
+		self.gw.learn_hotpixels(frames)
+		self.aw.capture_full(frames)
+
+	def set_policy(self, name, policy):
+		self.queues[name].set_policy(policy)
+
+	def set_keep(self, keep):
+		# Whether autosaved frames may be dropped to keep the preview live
+		self.aw.set_keep(keep)
+
+	def set_gain(self, gain):
+		self.dw.set_gain(gain)
+
+	def once(self):
+		self.aw.set_state(LiveUpdate.ONCE)
+
+	def live(self, status):
+		if (status):
+			self.aw.set_state(LiveUpdate.RUN)
+		else:
+			self.aw.set_state(LiveUpdate.PAUSE)
+
+	def autosave(self, status):
+		self.fw.set_state(status)
+		self.aw.set_full(status)
+
+	def autosave_motion(self, status):
+		# Autosave keeps only the frames with something moving in them
+		self.fw.set_motion(status)
+
+	def set_mask(self, mask):
+		self.dw.set_mask(mask)
+
+	def set_ring(self, ring, trigger = True):
+		# Exports go through the writer, in the format chosen for saving
+		ring.writer = self.writer
+		self.fw.set_ring(ring, trigger)
+
+	def set_catalog(self, catalog):
+		self.fw.set_catalog(catalog)
+
+	def record_event(self, before = 5.0, after = 5.0):
+		if (self.fw.ring is not None):
+			self.fw.ring.trigger(before, after)
+
+	def save(self):
+		self.aw.save_once()
+
+	def set_format(self, format):
+		self.writer.set_format(format)
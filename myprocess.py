@@ -0,0 +1,144 @@
+import concurrent.futures
+import multiprocessing
+from multiprocessing import shared_memory
+import threading
+import weakref
+import numpy as np
+
+# Blocks attached by this process, by name
+attached = {}
+
+def prune(live):
+	# Blocks freed by the parent since, none of their arrays outlive a call
+	for name in list(attached):
+		if (name not in live):
+			attached.pop(name).close()
+
+def attach_block(name):
+	if (name not in attached):
+		try:
+			# Only the creating process may unlink the block
+			attached[name] = shared_memory.SharedMemory(name=name, track=False)
+		except TypeError:
+			attached[name] = shared_memory.SharedMemory(name=name)
+	return attached[name]
+
+class SharedArray:
+	# Picklable reference to an array (or a view of one) in a shared memory block
+	def __init__(self, name, offset, shape, strides, dtype):
+		self.name = name
+		self.offset = offset
+		self.shape = shape
+		self.strides = strides
+		self.dtype = dtype
+
+	def attach(self):
+		block = attach_block(self.name)
+		return np.ndarray(self.shape, self.dtype, buffer=block.buf, offset=self.offset, strides=self.strides)
+
+class SharedArrays:
+	def __init__(self):
+		self.blocks = []
+		# Blocks not unlinked yet, freed ones included, by name
+		self.linked = {}
+		self.lock = threading.Lock()
+
+	def address(self, array):
+		return array.__array_interface__['data'][0]
+
+	def empty(self, shape, dtype = np.uint8):
+		size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+		block = shared_memory.SharedMemory(create=True, size=size)
+		array = np.ndarray(shape, dtype, buffer=block.buf)
+		with self.lock:
+			self.blocks.append((block, self.address(array)))
+			self.linked[block.name] = block
+		# Views keep the array alive but hold no buffer export, so the block is
+		# unmapped once the array and every view of it are gone, never before
+		weakref.finalize(array, self.drop, block).atexit = False
+		return array
+
+	def find(self, array):
+		address = self.address(array)
+		with self.lock:
+			blocks = list(self.blocks)
+		for block, base in blocks:
+			if (base <= address < base + block.size):
+				return block, base
+		return None, None
+
+	def names(self):
+		with self.lock:
+			return [block.name for block, base in self.blocks]
+
+	def describe(self, array):
+		if (not isinstance(array, np.ndarray)):
+			return array
+		block, base = self.find(array)
+		if (block is None):
+			# Not shared, this one gets pickled
+			return array
+		return SharedArray(block.name, self.address(array) - base, array.shape, array.strides, array.dtype.str)
+
+	def submit(self, pool, func, *args):
+		args = [self.describe(arg) for arg in args]
+		return pool.submit(invoke, self.names(), func, *args)
+
+	def release(self, block):
+		with self.lock:
+			self.blocks = [(b, base) for b, base in self.blocks if b is not block]
+
+	def unlink(self, block):
+		with self.lock:
+			linked = self.linked.pop(block.name, None) is not None
+		if (linked):
+			block.unlink()
+
+	def drop(self, block):
+		# The last array using the block is gone, freed or just replaced
+		self.release(block)
+		self.unlink(block)
+		block.close()
+
+	def free(self, array):
+		# Never handed out again. A frame still in flight keeps the block until
+		# it is done, the pool attaches it by name
+		block, base = self.find(array)
+		if (block is not None):
+			self.release(block)
+
+	def close(self):
+		with self.lock:
+			blocks = list(self.linked.values())
+			self.blocks = []
+		for block in blocks:
+			self.unlink(block)
+
+def invoke(live, func, *args):
+	prune(live)
+	args = [arg.attach() if isinstance(arg, SharedArray) else arg for arg in args]
+	return func(*args)
+
+class LocalExecutor:
+	def call(self, func, *args):
+		return func(*args)
+
+	def shutdown(self):
+		pass
+
+def process_pool(processes = None):
+	# Workers are forked from a server process started clean, never from one that
+	# already runs threads and holds the camera. Importing the modules opens nothing
+	return concurrent.futures.ProcessPoolExecutor(processes, multiprocessing.get_context('forkserver'))
+
+class ProcessExecutor:
+	# Runs kernels in a process pool, arrays in shared memory are passed by reference
+	def __init__(self, arrays, processes = None):
+		self.arrays = arrays
+		self.pool = process_pool(processes)
+
+	def call(self, func, *args):
+		return self.arrays.submit(self.pool, func, *args).result()
+
+	def shutdown(self):
+		self.pool.shutdown()
@@ -0,0 +1,164 @@
+import math
+import numpy as np
+from mybayer import luma
+
+modes = ['shift', 'rotate']
+
+class Transform:
+	# Where a pixel p of the reference is found in the frame: R(angle) (p - centre) + centre + (dy, dx)
+	def __init__(self, dy = 0.0, dx = 0.0, angle = 0.0):
+		self.dy = dy
+		self.dx = dx
+		self.angle = angle
+
+	def __str__(self):
+		return "dy {:+.2f} dx {:+.2f} angle {:+.3f}".format(self.dy, self.dx, math.degrees(self.angle))
+
+def downsample(frame, factor):
+	# Block means of the luminance, in bayer data a block mixes the four colours anyway.
+	# Summing strided views is several times faster than a mean over a reshaped frame
+	height = frame.shape[0] // factor * factor
+	width = frame.shape[1] // factor * factor
+	if (frame.ndim == 2):
+		frame = frame[..., np.newaxis]
+	small = np.zeros((height // factor, width // factor, frame.shape[2]), dtype=np.float32)
+	for y in range(factor):
+		for x in range(factor):
+			small += frame[y:height:factor, x:width:factor]
+	small /= factor * factor
+	if (small.shape[-1] == 3):
+		return small @ luma
+	return small[..., 0]
+
+def upsampled_dft(data, size, factor, offset):
+	# The inverse DFT on a grid factor times finer, only size x size points around offset.
+	# Two small matrix products instead of an FFT of a factor times larger frame
+	for n, start in reversed(list(zip(data.shape, offset))):
+		kernel = np.exp(-2j * np.pi * (np.arange(size) - start)[:, np.newaxis] * np.fft.fftfreq(n, factor))
+		data = np.tensordot(kernel, data, axes=(1, -1))
+	return data
+
+def phase_correlate(reference, spectrum, upsample = 20):
+	# Shift s with frame(p + s) = reference(p), from the spectra of both
+	cross = reference * spectrum.conj()
+	# Whitened, the peak is sharp enough to find the whole pixel shift
+	correlation = np.abs(np.fft.ifft2(cross / np.maximum(np.abs(cross), 1e-9)))
+	shape = np.array(correlation.shape)
+	shift = np.array(np.unravel_index(np.argmax(correlation), correlation.shape), dtype=np.float64)
+	wrapped = shift > shape // 2
+	shift[wrapped] -= shape[wrapped]
+
+	# Refine around the peak to 1 / upsample of a pixel. On the plain cross power spectrum,
+	# whitening weights the noisy high frequencies up and pulls the fraction off
+	size = math.ceil(upsample * 1.5)
+	centre = size // 2
+	shift = np.round(shift * upsample) / upsample
+	fine = np.abs(upsampled_dft(cross.conj(), size, upsample, centre - shift * upsample))
+	peak = np.array(np.unravel_index(np.argmax(fine), fine.shape))
+	return -(shift + (peak - centre) / upsample)
+
+def shift_axis(frame, shift, axis):
+	# out[i] = frame[i + shift], linear between the two nearest pixels, edges are repeated
+	n = frame.shape[axis]
+	whole = math.floor(shift)
+	fraction = np.float32(shift - whole)
+	index = np.arange(n) + whole
+	before = frame.take(np.clip(index, 0, n - 1), axis)
+	after = frame.take(np.clip(index + 1, 0, n - 1), axis)
+	return before * (1 - fraction) + after * fraction
+
+def warp(frame, transform):
+	# Resamples the frame onto the grid of the reference
+	if (frame.ndim == 2):
+		# Bayer data only moves by whole colour blocks, interpolating would mix the colours
+		dy = 2 * round(transform.dy / 2)
+		dx = 2 * round(transform.dx / 2)
+		return shift_axis(shift_axis(frame, dy, 0), dx, 1)
+	if (transform.angle == 0):
+		# Separable, two one dimensional passes
+		return shift_axis(shift_axis(frame, transform.dy, 0), transform.dx, 1)
+
+	height, width = frame.shape[:2]
+	cy = (height - 1) / 2
+	cx = (width - 1) / 2
+	cos = math.cos(transform.angle)
+	sin = math.sin(transform.angle)
+	y = np.arange(height, dtype=np.float32)[:, np.newaxis] - cy
+	x = np.arange(width, dtype=np.float32)[np.newaxis, :] - cx
+	qy = np.clip(cos * y - sin * x + (cy + transform.dy), 0, height - 1.001)
+	qx = np.clip(sin * y + cos * x + (cx + transform.dx), 0, width - 1.001)
+	fy = (qy - np.floor(qy))[..., np.newaxis]
+	fx = (qx - np.floor(qx))[..., np.newaxis]
+	# Gathering from the flattened frame is about twice as fast as indexing it with two arrays
+	index = qy.astype(np.intp) * width + qx.astype(np.intp)
+	flat = frame.reshape(height * width, -1)
+	out = flat.take(index, axis=0) * (1 - fx)
+	out += flat.take(index + 1, axis=0) * fx
+	out *= 1 - fy
+	bottom = flat.take(index + width, axis=0) * (1 - fx)
+	bottom += flat.take(index + width + 1, axis=0) * fx
+	bottom *= fy
+	out += bottom
+	return out
+
+class Registration:
+	# Aligns every frame on the first one. Only the FFT of the reference is kept,
+	# every frame costs one FFT of its downsampled luminance, two with rotation
+	def __init__(self, mode = 'shift', factor = 2, upsample = 20, angles = 360):
+		self.rotate = (mode == 'rotate')
+		self.factor = factor
+		self.upsample = upsample
+		self.angles = angles
+		self.reference = None
+		self.polar_reference = None
+		self.window = None
+		self.rows = None
+		self.cols = None
+
+	def prepare(self, shape):
+		height, width = shape
+		# Without a window the frame edges are the strongest feature and never move
+		self.window = np.outer(np.hanning(height), np.hanning(width)).astype(np.float32)
+		# Sample points of the polar spectrum, the middle frequencies carry the detail
+		angles = np.arange(self.angles) * math.pi / self.angles
+		radii = np.linspace(0.05, 0.45, min(height, width) // 2)
+		self.rows = np.round(np.outer(np.sin(angles), radii) * height).astype(np.intp) % height
+		self.cols = np.round(np.outer(np.cos(angles), radii) * width).astype(np.intp) % width
+
+	def spectrum(self, small):
+		if (self.window is None or self.window.shape != small.shape):
+			self.prepare(small.shape)
+		small -= small.mean()
+		small *= self.window
+		return np.fft.fft2(small)
+
+	def polar(self, spectrum):
+		# The magnitude ignores shifts, and a rotation of the frame is a shift along the angle
+		magnitude = np.log1p(np.abs(spectrum))
+		return np.fft.fft2(magnitude[self.rows, self.cols])
+
+	def set_reference(self, frame):
+		self.reference = self.spectrum(downsample(frame, self.factor))
+		if (self.rotate):
+			self.polar_reference = self.polar(self.reference)
+
+	def estimate(self, frame):
+		small = downsample(frame, self.factor)
+		angle = 0.0
+		if (self.rotate):
+			shift = phase_correlate(self.polar_reference, self.polar(self.spectrum(small.copy())), self.upsample)
+			angle = -shift[0] * math.pi / self.angles
+			small = warp(small[..., np.newaxis], Transform(0, 0, angle))[..., 0]
+		dy, dx = phase_correlate(self.reference, self.spectrum(small), self.upsample)
+		# Measured on the frame turned back, so the shift turns with it
+		cos = math.cos(angle)
+		sin = math.sin(angle)
+		return Transform((cos * dy - sin * dx) * self.factor, (sin * dy + cos * dx) * self.factor, angle)
+
+	def align(self, frame):
+		if (self.reference is None):
+			self.set_reference(frame)
+			return frame
+		transform = self.estimate(frame)
+		print("Align {}".format(transform))
+		return warp(frame, transform)
@@ -0,0 +1,164 @@
+import datetime
+import os
+import threading
+import time
+import numpy as np
+import mywriter
+from mymetrics import Metrics
+
+# One record per slot, a sequence of -1 marks a slot that holds no frame
+record = np.dtype([('sequence', np.int64), ('time', np.float64), ('monotonic', np.float64), ('motion', np.bool_)])
+
+class Export:
+	# The frames from before seconds ahead of the trigger up to after seconds past it
+	def __init__(self, name, start, deadline):
+		self.name = name
+		self.start = start
+		self.deadline = deadline
+		self.end = None
+		self.thread = None
+
+class FrameRing:
+	# The most recent frames in a memory mapped file of a fixed size. Frames are copied into
+	# their slot, RAM and disk use stay the same however long it runs. A trigger pins the
+	# frames around it until they are exported, the live frames are dropped rather than
+	# overwriting them when the ring is too small
+	def __init__(self, path = '/share/pics/ring', count = 300, events = '/share/pics/events', writer = None, metrics = None):
+		self.path = path
+		self.count = count
+		self.events = events
+		self.writer = writer
+		self.frames = None
+		self.meta = None
+		self.filename = None
+		self.sequence = 0
+		self.exports = []
+		self.lock = threading.Lock()
+
+		if (metrics is None):
+			metrics = Metrics()
+		self.written = metrics.counter("ring.frames")
+		self.dropped = metrics.counter("ring.dropped")
+		self.exported = metrics.counter("ring.exports")
+
+	def open(self, shape, dtype):
+		# A file per frame shape, the old one goes as the resolution changes
+		dtype = np.dtype(dtype)
+		filename = os.path.join(self.path, "ring_{}_{}.npy".format("x".join(str(n) for n in shape), dtype.name))
+		os.makedirs(self.path, exist_ok=True)
+		with self.lock:
+			if (self.filename is not None and self.filename != filename):
+				os.remove(self.filename)
+			shape = (self.count,) + tuple(shape)
+			frames = None
+			if (os.path.exists(filename)):
+				try:
+					frames = np.load(filename, mmap_mode='r+')
+				except ValueError:
+					frames = None
+				if (frames is not None and (frames.shape != shape or frames.dtype != dtype)):
+					frames = None
+			if (frames is None):
+				print("Create ring '{}' ({:.0f} MB)".format(filename, np.prod(shape) * dtype.itemsize / 1e6))
+				frames = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=shape)
+			self.frames = frames
+			self.filename = filename
+			# Frames of an earlier run are not worth keeping, their clock is not this one
+			self.meta = np.lib.format.open_memmap(os.path.join(self.path, "ring_meta.npy"), mode='w+',
+				dtype=record, shape=(self.count,))
+			self.meta['sequence'] = -1
+
+	def flush(self):
+		# Pending exports end here, with what the ring holds so far
+		with self.lock:
+			exports = list(self.exports)
+		for export in exports:
+			if (export.thread is None):
+				self.finish(export)
+		for export in exports:
+			export.thread.join()
+
+	def close(self):
+		self.flush()
+		with self.lock:
+			self.frames = None
+			self.meta = None
+
+	def pinned(self, sequence):
+		return any(export.start <= sequence for export in self.exports)
+
+	def write(self, frame, motion = False):
+		if (self.frames is None or self.frames.shape[1:] != frame.shape or self.frames.dtype != frame.dtype):
+			# Reopening empties every slot, the frames of pending exports are saved first
+			self.flush()
+			self.open(frame.shape, frame.dtype)
+		# Exports that are due first, they free their slots once exported
+		self.finish_due()
+		with self.lock:
+			slot = self.sequence % self.count
+			old = self.meta['sequence'][slot]
+			if (old >= 0 and self.pinned(old)):
+				self.dropped.inc()
+				return False
+			# Marked empty while it is copied, exports never see half a frame
+			self.meta['sequence'][slot] = -1
+		np.copyto(self.frames[slot], frame)
+		with self.lock:
+			self.meta[slot] = (self.sequence, time.time(), time.monotonic(), motion)
+			self.sequence += 1
+		self.written.inc()
+		return True
+
+	def finish_due(self):
+		now = time.monotonic()
+		with self.lock:
+			due = [export for export in self.exports if export.thread is None and export.deadline <= now]
+		for export in due:
+			self.finish(export)
+
+	def trigger(self, before = 5.0, after = 5.0):
+		# Freezes the frames from before seconds ago on, they are exported after seconds from now
+		now = time.monotonic()
+		with self.lock:
+			if (self.meta is None):
+				return None
+			valid = self.meta['sequence'] >= 0
+			recent = valid & (self.meta['monotonic'] >= now - before)
+			start = int(self.meta['sequence'][recent].min()) if recent.any() else self.sequence
+			name = "event_" + datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:-3]
+			export = Export(name, start, now + after)
+			self.exports.append(export)
+		print("Trigger '{}' from frame {}".format(name, start))
+		return export
+
+	def finish(self, export):
+		with self.lock:
+			export.end = self.sequence - 1
+			export.thread = threading.Thread(target=self.export, args=(export,))
+		export.thread.start()
+
+	def export(self, export):
+		folder = os.path.join(self.events, export.name)
+		os.makedirs(folder, exist_ok=True)
+		with self.lock:
+			frames = self.frames
+			meta = self.meta.copy()
+		wanted = (meta['sequence'] >= export.start) & (meta['sequence'] <= export.end)
+		slots = np.flatnonzero(wanted)
+		slots = slots[np.argsort(meta['sequence'][slots])]
+		lines = ["sequence,time,monotonic,motion"]
+		for slot in slots:
+			sequence, wall, monotonic, motion = meta[slot]
+			stamp = datetime.datetime.fromtimestamp(wall).strftime("%Y%m%d_%H%M%S_%f")[:-3]
+			basename = os.path.join(folder, "{:08d}_{}".format(sequence, stamp))
+			if (self.writer is not None):
+				# The writer takes a copy, the slot is free again once all are queued
+				self.writer.write(frames[slot], basename)
+			else:
+				mywriter.write_atomic(basename + '.npy', mywriter.encode(np.array(frames[slot]), 'npy'))
+			lines.append("{},{:.6f},{:.6f},{}".format(sequence, wall, monotonic, int(motion)))
+		mywriter.write_atomic(os.path.join(folder, "frames.csv"), ("\n".join(lines) + "\n").encode('ascii'))
+		with self.lock:
+			self.exports.remove(export)
+		self.exported.inc()
+		print("Exported {} frames to '{}'".format(len(slots), folder))
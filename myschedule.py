@@ -0,0 +1,61 @@
+import time
+from mymetrics import Metrics
+
+policies = ['skip', 'catch-up']
+
+class Schedule:
+	# Shots at absolute deadlines on the monotonic clock, so late shots do not push the later ones
+	def __init__(self, interval, policy = 'skip', metrics = None):
+		self.interval = interval
+		self.policy = policy
+		self.start = time.monotonic()
+		self.slot = 0
+		self.set_metrics(Metrics() if metrics is None else metrics)
+
+	def set_metrics(self, metrics):
+		self.jitter = metrics.histogram("schedule.jitter_ms")
+		self.missed = metrics.counter("schedule.missed")
+
+	def reset(self):
+		# The next shot is due now, the ones before are forgotten
+		self.start = time.monotonic()
+		self.slot = 0
+
+	def deadline(self):
+		return self.start + self.slot * self.interval
+
+	def due(self):
+		# Seconds until the next shot, zero or less once it is due
+		return self.deadline() - time.monotonic()
+
+	def skip(self):
+		# With the skip policy a slot that is over by the time it is waited for
+		# is dropped, the latest slot that is due is taken instead
+		if (self.policy == 'skip' and self.interval > 0):
+			missed = int((time.monotonic() - self.deadline()) // self.interval)
+			if (missed > 0):
+				self.slot += missed
+				self.missed.inc(missed)
+				print("Missed {} slots".format(missed))
+		# Catching up leaves them due, they are taken back to back
+
+	def wait(self):
+		self.skip()
+		while True:
+			remaining = self.due()
+			if (remaining <= 0):
+				break
+			time.sleep(remaining)
+		return self.fire()
+
+	def fire(self):
+		# Called as the shot is taken, records how late it was
+		if (self.interval <= 0):
+			# Back to back, there is no deadline to be late for
+			self.slot += 1
+			return None
+		jitter = (time.monotonic() - self.deadline()) * 1000
+		self.jitter.add(jitter)
+		print("Shot {} at {:+.1f} ms".format(self.slot, jitter))
+		self.slot += 1
+		return jitter
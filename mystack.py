@@ -0,0 +1,136 @@
+import numpy as np
+import mywriter
+
+class Stacker:
+	def __init__(self):
+		self.count = 0
+		self.white = 255.0
+
+	def start(self, frame):
+		if (np.issubdtype(frame.dtype, np.integer)):
+			self.white = float(np.iinfo(frame.dtype).max)
+
+	def add(self, frame):
+		if (self.count == 0):
+			self.start(frame)
+		self.count += 1
+
+	def result(self):
+		return None
+
+	def peak(self):
+		return self.white
+
+class SumStacker(Stacker):
+	def __init__(self):
+		Stacker.__init__(self)
+		self.sum = None
+
+	def start(self, frame):
+		Stacker.start(self, frame)
+		self.sum = np.zeros(frame.shape, dtype=np.float32)
+
+	def add(self, frame):
+		Stacker.add(self, frame)
+		self.sum += frame
+
+	def result(self):
+		return self.sum
+
+	def peak(self):
+		# A sum is stretched to its brightest pixel
+		return max(float(self.sum.max()), 1.0)
+
+class MeanStacker(SumStacker):
+	def result(self):
+		return self.sum / self.count
+
+	def peak(self):
+		return self.white
+
+class MaxStacker(Stacker):
+	def __init__(self):
+		Stacker.__init__(self)
+		self.max = None
+
+	def start(self, frame):
+		Stacker.start(self, frame)
+		self.max = np.zeros(frame.shape, dtype=np.float32)
+
+	def add(self, frame):
+		Stacker.add(self, frame)
+		np.maximum(self.max, frame, out=self.max)
+
+	def result(self):
+		return self.max
+
+class SigmaClipStacker(Stacker):
+	# Single pass approximation of sigma clipping: every frame is clipped against
+	# the running mean and deviation of the frames before it
+	def __init__(self, kappa = 3.0, warmup = 3):
+		Stacker.__init__(self)
+		self.kappa = kappa
+		self.warmup = warmup
+
+	def start(self, frame):
+		Stacker.start(self, frame)
+		self.mean = np.zeros(frame.shape, dtype=np.float32)
+		self.m2 = np.zeros(frame.shape, dtype=np.float32)
+		self.sum = np.zeros(frame.shape, dtype=np.float32)
+		self.num = np.zeros(frame.shape, dtype=np.float32)
+		self.frame = np.empty(frame.shape, dtype=np.float32)
+		self.delta = np.empty(frame.shape, dtype=np.float32)
+		self.bound = np.empty(frame.shape, dtype=np.float32)
+		self.keep = np.empty(frame.shape, dtype=bool)
+
+	def add(self, frame):
+		Stacker.add(self, frame)
+		np.copyto(self.frame, frame, casting='unsafe')
+		np.subtract(self.frame, self.mean, out=self.delta)
+
+		if (self.count > self.warmup):
+			# kappa * stddev, with one step of slack so noise free pixels are kept
+			np.divide(self.m2, self.count - 2, out=self.bound)
+			np.sqrt(self.bound, out=self.bound)
+			self.bound *= self.kappa
+			self.bound += self.white / 255
+			np.less_equal(np.abs(self.delta), self.bound, out=self.keep)
+			np.add(self.sum, self.frame, out=self.sum, where=self.keep)
+			self.num += self.keep
+		else:
+			self.sum += self.frame
+			self.num += 1
+
+		# Welford update of the running mean and squared deviation
+		self.mean += self.delta / self.count
+		np.subtract(self.frame, self.mean, out=self.bound)
+		self.bound *= self.delta
+		self.m2 += self.bound
+
+	def result(self):
+		return np.divide(self.sum, self.num, out=self.mean.copy(), where=self.num > 0)
+
+stackers = {
+	'mean': MeanStacker,
+	'sum': SumStacker,
+	'max': MaxStacker,
+	'sigma-clip': SigmaClipStacker,
+}
+
+def create(mode):
+	return stackers[mode]()
+
+def save(stacker, filename, depth = 8):
+	result = stacker.result()
+	peak = stacker.peak()
+	if (depth == 16):
+		# PIL cannot write 16 bit colour images, netpbm can
+		filename = filename.rsplit('.', 1)[0] + ('.ppm' if result.ndim == 3 else '.pgm')
+		array = np.clip(result * (65535 / peak), 0, 65535).astype(np.uint16)
+		mywriter.write_atomic(filename, mywriter.encode_ppm16(array))
+	else:
+		from PIL import Image
+		array = np.clip(result * (255 / peak), 0, 255).astype(np.uint8)
+		Image.fromarray(array).save(filename)
+	print("Stacked {} images into '{}'".format(stacker.count, filename))
+	return filename
@@ -0,0 +1,115 @@
+import math
+import numpy as np
+from mybayer import luma
+
+class FrameStats:
+	# Per channel histograms of every step-th pixel. Everything else is worked out from
+	# the histograms, nothing is sorted. alpha below 1 smooths them over frames
+	def __init__(self, step = 8, bins = 256, alpha = 1.0):
+		self.step = step
+		self.bins = bins
+		self.alpha = alpha
+		self.hist = None
+		self.white = 255
+		self.count = 0
+
+	def update(self, frame):
+		grid = frame[::self.step, ::self.step]
+		if (grid.ndim == 2):
+			grid = grid[..., np.newaxis]
+		channels = grid.shape[2]
+		# Raw frames are left aligned, white is the top of the integer range either way
+		self.white = np.iinfo(grid.dtype).max
+		index = grid.astype(np.int32)
+		if (self.white + 1 != self.bins):
+			index = np.minimum(index * self.bins // (self.white + 1), self.bins - 1)
+		index += np.arange(channels, dtype=np.int32) * self.bins
+		hist = np.bincount(index.ravel(), minlength=channels * self.bins).reshape(channels, self.bins)
+		hist = hist.astype(np.float32) / (grid.shape[0] * grid.shape[1])
+		if (self.hist is None or self.hist.shape != hist.shape or self.alpha >= 1):
+			self.hist = hist
+		else:
+			self.hist += self.alpha * (hist - self.hist)
+		self.count += 1
+		return self
+
+	def centres(self):
+		# Bin centres as a fraction of white
+		return (np.arange(self.bins, dtype=np.float32) + 0.5) / self.bins
+
+	def mean(self, gamma = 1.0):
+		# Per channel, gamma turns encoded values back into light
+		return self.hist @ (self.centres() ** gamma)
+
+	def level(self, gamma = 1.0):
+		means = self.mean(gamma)
+		if (len(means) == 3):
+			return float(means @ luma)
+		return float(means.mean())
+
+	def percentile(self, percent):
+		# Per channel, as a fraction of white
+		cdf = np.cumsum(self.hist, axis=1)
+		index = [np.searchsorted(channel, percent / 100) for channel in cdf]
+		return np.minimum(np.array(index), self.bins - 1) / (self.bins - 1)
+
+	def clipped(self):
+		# Fraction of the pixels in the bottom and in the top bin, of the worst channel
+		return float(self.hist[:, 0].max()), float(self.hist[:, -1].max())
+
+	def summary(self):
+		# The few numbers worth keeping with a saved frame
+		low, high = self.clipped()
+		return {
+			'mean': float(self.mean().mean()),
+			'p99': float(self.percentile(99).max()),
+			'clipped': high,
+		}
+
+	def __str__(self):
+		low, high = self.clipped()
+		return "mean {} p50 {} p99 {} clipped {:.1%}/{:.1%}".format(
+			np.round(self.mean(), 3), np.round(self.percentile(50), 3), np.round(self.percentile(99), 3), low, high)
+
+class ExposureController:
+	# Light on the sensor goes with exposure x gain, so the step that takes the mean
+	# linear level to the target is known from one frame. Clipped frames read too dark,
+	# they are taken down by a step that grows with the clipped fraction instead
+	def __init__(self, target = 0.18, gamma = 2.2, tolerance = 0.25, max_step = 64.0, max_clipped = 0.005,
+		min_exposure = 1, max_exposure = 6000, isos = [100, 200, 400, 800, 1600]):
+		self.target = target
+		self.gamma = gamma
+		self.tolerance = tolerance
+		self.max_step = max_step
+		self.max_clipped = max_clipped
+		self.min_exposure = min_exposure
+		self.max_exposure = max_exposure
+		self.isos = isos
+
+	def factor(self, stats):
+		level = stats.level(self.gamma)
+		factor = self.max_step if level <= 0 else self.target / level
+		low, high = stats.clipped()
+		if (high > self.max_clipped):
+			# The more is clipped the less the level tells, all white takes the largest step
+			factor = min(factor, 1 / (1 + high * self.max_step))
+		return min(max(factor, 1 / self.max_step), self.max_step)
+
+	def split(self, total):
+		# The lowest ISO that gets there within the longest exposure, for the least noise
+		for iso in self.isos:
+			if (total / iso <= self.max_exposure):
+				return max(self.min_exposure, int(round(total / iso))), iso
+		return self.max_exposure, self.isos[-1]
+
+	def update(self, stats, exposure, iso):
+		# New (exposure, iso) for a frame taken at exposure ms and iso, or None when it is good
+		factor = self.factor(stats)
+		if (abs(math.log2(factor)) <= self.tolerance):
+			return None
+		settings = self.split(exposure * max(iso, self.isos[0]) * factor)
+		if (settings == (exposure, iso)):
+			# At a limit, nothing more to do
+			return None
+		print("Exposure {} ms ISO {} -> {} ms ISO {} ({:+.1f} EV)".format(exposure, iso, settings[0], settings[1], math.log2(factor)))
+		return settings
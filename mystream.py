@@ -0,0 +1,179 @@
+import argparse
+import asyncio
+import concurrent.futures
+import threading
+import time
+import mywriter
+import mybackend
+from mymetrics import Metrics
+
+modes = ['now', 'avg', 'diff']
+
+index = """<html><head><title>MyCamera</title></head><body>
+<p><a href="/now">Now</a> <a href="/avg">Avg</a> <a href="/diff">Diff</a></p>
+<img src="/now">
+</body></html>
+"""
+
+class Channel:
+	# One display mode. Every frame is encoded once, whatever the number of clients
+	def __init__(self, name):
+		self.name = name
+		self.clients = set()
+		self.frame = None
+		self.encoding = False
+
+class StreamServer(threading.Thread):
+	# MJPEG over HTTP, served by an asyncio loop on its own thread. Every client has
+	# a queue of one frame, so a slow client misses frames instead of holding anything up
+	def __init__(self, host = '0.0.0.0', port = 8080, quality = 80, metrics = None):
+		threading.Thread.__init__(self, daemon=True)
+		self.host = host
+		self.port = port
+		self.quality = quality
+		self.channels = {mode: Channel(mode) for mode in modes}
+		self.lock = threading.Lock()
+		self.pool = concurrent.futures.ThreadPoolExecutor(len(modes))
+		self.loop = None
+		self.stopping = None
+		self.ready = threading.Event()
+
+		if (metrics is None):
+			metrics = Metrics()
+		self.timing = metrics.histogram("stream.encode_ms")
+		self.frames = metrics.counter("stream.frames")
+		self.dropped = metrics.counter("stream.dropped")
+
+	def run(self):
+		self.loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(self.loop)
+		self.loop.run_until_complete(self.serve())
+		self.loop.close()
+
+	async def serve(self):
+		self.stopping = asyncio.Event()
+		server = await asyncio.start_server(self.handle, self.host, self.port)
+		self.port = server.sockets[0].getsockname()[1]
+		print("Streaming on port {}".format(self.port))
+		self.ready.set()
+		async with server:
+			await self.stopping.wait()
+		# Clients stream forever, they have to be told to stop
+		tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+		for task in tasks:
+			task.cancel()
+		await asyncio.gather(*tasks, return_exceptions=True)
+
+	def stop(self):
+		if (self.loop is not None):
+			self.loop.call_soon_threadsafe(self.stopping.set)
+		self.join()
+		self.pool.shutdown()
+
+	def watched(self, mode):
+		return self.loop is not None and len(self.channels[mode].clients) > 0
+
+	def publish(self, mode, array):
+		# Called from the pipeline, only keeps a copy and wakes the loop
+		channel = self.channels[mode]
+		if (array is None or not self.watched(mode)):
+			return
+		with self.lock:
+			channel.frame = array.copy()
+		self.loop.call_soon_threadsafe(self.wake, channel)
+
+	def wake(self, channel):
+		if (not channel.encoding):
+			channel.encoding = True
+			self.loop.create_task(self.encode(channel))
+
+	def take(self, channel):
+		with self.lock:
+			frame = channel.frame
+			channel.frame = None
+			return frame
+
+	async def encode(self, channel):
+		# Frames that arrive while one is encoded replace each other, only the latest gets encoded next
+		frame = self.take(channel)
+		while frame is not None:
+			t1 = time.monotonic()
+			jpeg = await self.loop.run_in_executor(self.pool, mywriter.encode, frame, 'jpeg', 1, self.quality)
+			self.timing.add((time.monotonic() - t1) * 1000)
+			self.frames.inc()
+			for client in channel.clients:
+				if (client.full()):
+					client.get_nowait()
+					self.dropped.inc()
+				client.put_nowait(jpeg)
+			frame = self.take(channel)
+		channel.encoding = False
+
+	async def handle(self, reader, writer):
+		try:
+			request = (await reader.readline()).decode('latin-1').split()
+			while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+				pass
+			path = request[1].strip('/') if len(request) > 1 else ''
+			if (path == ''):
+				writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/html\r\n\r\n" + index.encode('ascii'))
+			elif (path in self.channels):
+				await self.stream(self.channels[path], writer)
+			else:
+				writer.write(b"HTTP/1.0 404 Not Found\r\n\r\n")
+			await writer.drain()
+		except (ConnectionError, asyncio.CancelledError):
+			pass
+		finally:
+			writer.close()
+
+	async def stream(self, channel, writer):
+		writer.write(b"HTTP/1.0 200 OK\r\n"
+			b"Cache-Control: no-cache\r\n"
+			b"Content-Type: multipart/x-mixed-replace; boundary=frame\r\n\r\n")
+		client = asyncio.Queue(1)
+		channel.clients.add(client)
+		print("Stream client on /{} ({})".format(channel.name, len(channel.clients)))
+		try:
+			while True:
+				jpeg = await client.get()
+				writer.write(b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: "
+					+ str(len(jpeg)).encode('ascii') + b"\r\n\r\n" + jpeg + b"\r\n")
+				await writer.drain()
+		finally:
+			channel.clients.discard(client)
+
+def parse_args():
+	parser = argparse.ArgumentParser(description="MyCamera MJPEG server")
+	parser.add_argument('--port', help='HTTP port', type=int, default=8080)
+	parser.add_argument('--quality', help='JPEG quality', type=int, default=80)
+	parser.add_argument('--backend', help='Camera backend', choices=mybackend.backends, default='picamera')
+	parser.add_argument('--replay', help='Folder of images for the replay backend')
+	parser.add_argument('--processes', '-p', help='Run the heavy stages in a pool of processes', type=int, default=0)
+	return parser.parse_args()
+
+def main():
+	# Headless, the pipeline only feeds the server
+	from mycamera import MyCamera
+	from mypipeline import LiveUpdater
+
+	args = parse_args()
+	mycam = MyCamera('auto', 0, backend=args.backend, path=args.replay)
+	mycam.open()
+	updater = LiveUpdater(mycam, None, processes=args.processes)
+	server = StreamServer(port=args.port, quality=args.quality, metrics=updater.metrics)
+	updater.set_server(server)
+	server.start()
+	updater.start()
+	updater.live(True)
+	try:
+		while True:
+			time.sleep(1)
+	except KeyboardInterrupt:
+		pass
+	updater.join()
+	server.stop()
+	mycam.close()
+
+if __name__ == "__main__":
+	main()
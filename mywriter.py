@@ -0,0 +1,401 @@
+import collections
+import io
+import itertools
+import os
+import queue
+import struct
+import threading
+import time
+import numpy as np
+from mymetrics import Metrics
+from myprocess import SharedArrays, process_pool
+
+extensions = {
+	'png': '.png',
+	'tiff': '.tif',
+	'ppm': '.ppm',
+	'npy': '.npy',
+	'jpeg': '.jpg',
+}
+
+def encode_ppm16(array):
+	height, width = array.shape[:2]
+	magic = 'P6' if array.ndim == 3 else 'P5'
+	header = "{}\n{} {}\n65535\n".format(magic, width, height).encode('ascii')
+	return header + array.astype('>u2').tobytes()
+
+def encode_tiff16(array):
+	# Baseline uncompressed TIFF in one strip, PIL cannot write 16 bit colour images
+	height, width = array.shape[:2]
+	samples = array.shape[2] if array.ndim == 3 else 1
+	data = array.astype('<u2').tobytes()
+	# The bits per sample of three channels do not fit in their entry, they go after the data
+	bits_offset = 8 + len(data)
+	ifd_offset = bits_offset + 8
+	short = 3
+	long = 4
+	entries = [
+		(256, long, 1, width),
+		(257, long, 1, height),
+		(258, short, samples, 16 if samples == 1 else bits_offset),
+		(259, short, 1, 1),
+		(262, short, 1, 2 if samples == 3 else 1),
+		(273, long, 1, 8),
+		(277, short, 1, samples),
+		(278, long, 1, height),
+		(279, long, 1, len(data)),
+		(284, short, 1, 1),
+	]
+	ifd = struct.pack('<H', len(entries))
+	for tag, kind, count, value in entries:
+		if (kind == short and count == 1):
+			# A single short sits in the first half of the value field
+			ifd += struct.pack('<HHIHH', tag, kind, count, value, 0)
+		else:
+			ifd += struct.pack('<HHII', tag, kind, count, value)
+	ifd += struct.pack('<I', 0)
+	header = struct.pack('<2sHI', b'II', 42, ifd_offset)
+	return header + data + struct.pack('<4H', 16, 16, 16, 0) + ifd
+
+def encode(array, format, compress_level = 1, quality = 95):
+	if (format == 'npy'):
+		stream = io.BytesIO()
+		np.save(stream, array)
+		return stream.getvalue()
+	if (format == 'ppm' and array.dtype == np.uint16):
+		# PIL cannot write 16 bit colour images, netpbm can
+		return encode_ppm16(array)
+	if (format == 'tiff' and array.dtype == np.uint16):
+		return encode_tiff16(array)
+	# PIL is only loaded once something is encoded with it
+	from PIL import Image
+	stream = io.BytesIO()
+	image = Image.fromarray(array)
+	if (format == 'png'):
+		image.save(stream, format='png', compress_level=compress_level)
+	elif (format == 'jpeg'):
+		image.save(stream, format='jpeg', quality=quality)
+	else:
+		# Uncompressed, these are about as fast as writing the raw bytes
+		image.save(stream, format=format)
+	return stream.getvalue()
+
+# Temporary files of this process, two writers of one path never share one
+temporary = itertools.count()
+
+def write_temp(path, data):
+	# Under a name of its own next to the final one, not synced yet
+	temp = "{}.{}.{}.tmp".format(path, os.getpid(), next(temporary))
+	try:
+		with open(temp, 'xb') as f:
+			f.write(data)
+	except BaseException:
+		if (os.path.exists(temp)):
+			os.remove(temp)
+		raise
+	return temp
+
+def sync_file(path):
+	fd = os.open(path, os.O_RDONLY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+def write_atomic(path, data):
+	# Readers never see a half written file. The data is on disk before the rename,
+	# or a power loss could leave an empty file under the final name
+	temp = write_temp(path, data)
+	try:
+		sync_file(temp)
+		os.replace(temp, path)
+	except BaseException:
+		if (os.path.exists(temp)):
+			os.remove(temp)
+		raise
+
+def sync_folders(paths):
+	# The files are synced before their rename, which is only durable once the folder is
+	folders = set(os.path.dirname(os.path.abspath(path)) for path in paths)
+	for folder in folders:
+		sync_file(folder)
+
+def commit(files):
+	# Renames a batch of (temp, path, done) into place. All of them are synced first,
+	# then renamed, then each folder is synced once, however many files it got
+	synced = []
+	for temp, path, done in files:
+		try:
+			sync_file(temp)
+			synced.append((temp, path, done))
+		except Exception as e:
+			print("Save '{}' failed: {}".format(path, e))
+			os.remove(temp)
+	renamed = []
+	for temp, path, done in synced:
+		try:
+			os.replace(temp, path)
+			renamed.append((path, done))
+		except Exception as e:
+			print("Save '{}' failed: {}".format(path, e))
+			os.remove(temp)
+	sync_folders([path for path, done in renamed])
+	for path, done in renamed:
+		# Only files that made it are reported
+		if (done is not None):
+			done()
+
+class FrameWriter:
+	def __init__(self, format = 'png', threads = 2, processes = 0, backlog = 8, compress_level = 1, sync = 8, metrics = None):
+		self.format = format
+		self.compress_level = compress_level
+		self.sync = sync
+		self.queue = queue.Queue(backlog)
+		self.threads = [threading.Thread(target=self.run) for i in range(threads)]
+		self.pool = None
+		self.arrays = None
+		if (processes > 0):
+			self.pool = process_pool(processes)
+			# Frames go to the pool by reference, in buffers that are reused
+			self.arrays = SharedArrays()
+		self.spare = []
+		self.lock = threading.Lock()
+		self.unsynced = []
+		self.started = time.monotonic()
+
+		if (metrics is None):
+			metrics = Metrics()
+		self.metrics = metrics
+		metrics.watch_queue("writer", self.queue)
+		self.timing = metrics.histogram("writer.ms")
+		self.frames = metrics.counter("writer.frames")
+		self.bytes = metrics.counter("writer.bytes")
+
+	def start(self):
+		for thread in self.threads:
+			thread.start()
+
+	def set_format(self, format):
+		print("Set format: {}".format(format))
+		self.format = format
+
+	def set_compress_level(self, compress_level):
+		self.compress_level = compress_level
+
+	def write(self, image, basename, format = None, copy = True, done = None):
+		if (format is None):
+			format = self.format
+		array = np.asarray(image)
+		if (self.arrays is not None):
+			array = self.share(array)
+		elif (copy and isinstance(image, np.ndarray)):
+			# The caller's buffer gets reused long before the file is written
+			array = array.copy()
+		path = basename + extensions[format]
+		# Blocks when the backlog is full, so memory stays bounded
+		self.queue.put((array, path, format, done))
+		return path
+
+	def write_encoded(self, data, path, done = None):
+		# Already encoded, only the write is left to do
+		self.queue.put((data, path, None, done))
+		return path
+
+	def share(self, array):
+		# A copy in shared memory. There are never more buffers than frames in the
+		# backlog and being encoded, a new frame size frees the ones of the old size
+		with self.lock:
+			if (len(self.spare) > 0 and (self.spare[0].shape != array.shape or self.spare[0].dtype != array.dtype)):
+				for spare in self.spare:
+					self.arrays.free(spare)
+				self.spare = []
+			if (len(self.spare) > 0):
+				buffer = self.spare.pop()
+			else:
+				buffer = self.arrays.empty(array.shape, array.dtype)
+		np.copyto(buffer, array)
+		return buffer
+
+	def recycle(self, array):
+		with self.lock:
+			if (len(self.spare) > 0 and (self.spare[0].shape != array.shape or self.spare[0].dtype != array.dtype)):
+				self.arrays.free(array)
+			else:
+				self.spare.append(array)
+
+	def encode(self, array, format):
+		if (self.pool is not None):
+			try:
+				return self.arrays.submit(self.pool, encode, array, format, self.compress_level).result()
+			finally:
+				self.recycle(array)
+		return encode(array, format, self.compress_level)
+
+	def run(self):
+		while True:
+			job = self.queue.get()
+			if (job is None):
+				self.queue.task_done()
+				break
+			array, path, format, done = job
+			try:
+				t1 = time.monotonic()
+				data = array
+				if (format is not None):
+					data = self.encode(array, format)
+				temp = write_temp(path, data)
+				t2 = time.monotonic()
+				self.timing.add((t2 - t1) * 1000)
+				self.frames.inc()
+				self.bytes.inc(len(data))
+				print("Save '{}'".format(path))
+				with self.lock:
+					self.unsynced.append((temp, path, done))
+			except Exception as e:
+				print("Save '{}' failed: {}".format(path, e))
+			# Out of work, what is written so far goes into place rather than wait for more
+			self.sync_batch(self.queue.empty())
+			self.queue.task_done()
+
+	def sync_batch(self, force = False):
+		# Files appear under their names sync frames at a time
+		with self.lock:
+			if (len(self.unsynced) < self.sync and not force):
+				return
+			files = self.unsynced
+			self.unsynced = []
+		if (len(files) > 0):
+			commit(files)
+
+	def stats(self):
+		elapsed = time.monotonic() - self.started
+		frames = self.frames.value
+		size = self.bytes.value
+		return {
+			'backlog': self.queue.qsize(),
+			'frames': frames,
+			'bytes': size,
+			'fps': frames / elapsed,
+			'mbps': size / elapsed / 1e6,
+		}
+
+	def flush(self):
+		self.queue.join()
+		self.sync_batch(True)
+
+	def close(self):
+		for thread in self.threads:
+			self.queue.put(None)
+		for thread in self.threads:
+			thread.join()
+		self.sync_batch(True)
+		if (self.pool is not None):
+			self.pool.shutdown()
+			self.arrays.close()
+		print("Writer: {frames} frames, {fps:.2f} fps, {mbps:.2f} MB/s".format(**self.stats()))
+
+def encode_to(array, path, format, compress_level, quality):
+	# Runs in the pool, the caller syncs and renames the file into place in capture order
+	data = encode(array, format, compress_level, quality)
+	with open(path + '.tmp', 'wb') as f:
+		f.write(data)
+	return len(data)
+
+class BatchEncoder:
+	# Bursts of frames encoded by a pool of processes, one per core. Frames are passed
+	# by reference in shared memory, captured straight into it where the camera can.
+	# At most count - 1 frames are in flight, so the ring of count buffers is never
+	# overwritten under the pool, and files appear in the order they were captured
+	def __init__(self, format = 'jpeg', processes = None, count = None, compress_level = 1, quality = 95, sync = 8, metrics = None):
+		self.format = format
+		self.processes = processes or os.cpu_count()
+		self.count = count or 2 * self.processes + 1
+		self.compress_level = compress_level
+		self.quality = quality
+		self.sync = sync
+		self.unsynced = []
+		self.arrays = SharedArrays()
+		self.ring = []
+		self.index = 0
+		self.pending = collections.deque()
+		self.pool = process_pool(self.processes)
+		self.started = None
+		self.finished = None
+
+		if (metrics is None):
+			metrics = Metrics()
+		self.timing = metrics.histogram("batch.ms")
+		self.frames = metrics.counter("batch.frames")
+		self.bytes = metrics.counter("batch.bytes")
+
+	def shared(self, frame):
+		# Frames from elsewhere are copied into the next buffer of the ring
+		block, base = self.arrays.find(frame)
+		if (block is not None):
+			return frame
+		if (len(self.ring) == 0 or self.ring[0].shape != frame.shape or self.ring[0].dtype != frame.dtype):
+			for buffer in self.ring:
+				self.arrays.free(buffer)
+			self.ring = [self.arrays.empty(frame.shape, frame.dtype) for i in range(self.count)]
+			self.index = 0
+		buffer = self.ring[self.index]
+		self.index = (self.index + 1) % self.count
+		np.copyto(buffer, frame)
+		return buffer
+
+	def wait(self):
+		# Called before every capture, frees the buffer it is about to be captured into
+		while len(self.pending) >= self.count - 1:
+			self.complete()
+
+	def submit(self, frame, path, done = None):
+		if (self.started is None):
+			self.started = time.monotonic()
+		frame = self.shared(frame)
+		future = self.arrays.submit(self.pool, encode_to, frame, path,
+			self.format, self.compress_level, self.quality)
+		self.pending.append((future, path, done, time.monotonic()))
+
+	def complete(self):
+		future, path, done, submitted = self.pending.popleft()
+		try:
+			size = future.result()
+		except Exception as e:
+			print("Encode '{}' failed: {}".format(path, e))
+			if (os.path.exists(path + '.tmp')):
+				os.remove(path + '.tmp')
+			return
+		self.finished = time.monotonic()
+		self.timing.add((self.finished - submitted) * 1000)
+		self.frames.inc()
+		self.bytes.inc(size)
+		self.unsynced.append((path + '.tmp', path, done))
+		if (len(self.unsynced) >= self.sync):
+			self.sync_batch()
+		if (self.frames.value % 100 == 0):
+			print("Encoded {frames} frames, {fps:.2f} fps".format(**self.stats()))
+
+	def sync_batch(self):
+		files = self.unsynced
+		self.unsynced = []
+		commit(files)
+
+	def stats(self):
+		elapsed = (self.finished or time.monotonic()) - (self.started or time.monotonic())
+		frames = self.frames.value
+		size = self.bytes.value
+		return {
+			'frames': frames,
+			'bytes': size,
+			'fps': frames / elapsed if elapsed > 0 else 0.0,
+			'mbps': size / elapsed / 1e6 if elapsed > 0 else 0.0,
+		}
+
+	def close(self):
+		while len(self.pending) > 0:
+			self.complete()
+		self.sync_batch()
+		self.pool.shutdown()
+		self.ring = []
+		self.arrays.close()
+		print("Batch: {frames} frames, {fps:.2f} fps sustained, {mbps:.2f} MB/s".format(**self.stats()))